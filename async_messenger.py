@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - asyncio facade
+Awaitable SecureMessenger calls for event-loop front ends
+"""
+
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncSecureMessenger:
+    """Run a SecureMessenger's blocking calls off the event loop
+
+    Encryption and decryption run on a bounded thread pool (the
+    cryptography primitives release the GIL, so RSA work runs in
+    parallel). Storage calls are serialized through a single database
+    thread, so the loop never waits on SQLite and writers never contend
+    with each other. Hybrid encryption still records its session key
+    through SQLite's own locking.
+
+    At most ``max_pending`` calls are queued or running at once; further
+    callers wait for a slot, which pushes back on whoever produces the
+    work. Cancelling a waiting call withdraws it if it has not started;
+    a call already running finishes in the background and its result is
+    dropped.
+    """
+
+    def __init__(self, messenger, max_workers=None, max_pending=None):
+        self.messenger = messenger
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.max_pending = max_pending or self.max_workers * 4
+
+        self._crypto = ThreadPoolExecutor(max_workers=self.max_workers,
+                                          thread_name_prefix="enclave-crypto")
+        self._db = ThreadPoolExecutor(max_workers=1, thread_name_prefix="enclave-db")
+        self._slots = None   # created on first use, inside the running loop
+        self.pending = 0
+
+    def _semaphore(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    async def _submit(self, executor, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        slots = self._semaphore()
+
+        waited = time.perf_counter()
+        await slots.acquire()
+        self.messenger.metrics.record('async_queue_wait', time.perf_counter() - waited)
+        self.pending += 1
+
+        def release(_future):
+            # The slot is held until the work is really done, even if the caller gave up
+            def free():
+                self.pending -= 1
+                slots.release()
+            try:
+                loop.call_soon_threadsafe(free)
+            except RuntimeError:
+                pass   # loop already closed
+
+        try:
+            future = executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self.pending -= 1
+            slots.release()
+            raise
+        future.add_done_callback(release)
+
+        # Cancelling the awaiting task cancels the job if it has not started
+        return await asyncio.wrap_future(future)
+
+    async def run_crypto(self, function, *args, **kwargs):
+        """Await ``function(*args, **kwargs)`` on the crypto pool"""
+        return await self._submit(self._crypto, function, *args, **kwargs)
+
+    async def run_db(self, function, *args, **kwargs):
+        """Await ``function(*args, **kwargs)`` on the database thread"""
+        return await self._submit(self._db, function, *args, **kwargs)
+
+    async def encrypt_message(self, recipient, message, **options):
+        """Awaitable SecureMessenger.encrypt_message"""
+        return await self.run_crypto(self.messenger.encrypt_message, recipient, message, **options)
+
+    async def decrypt_message(self, encrypted_message):
+        """Awaitable SecureMessenger.decrypt_message"""
+        return await self.run_crypto(self.messenger.decrypt_message, encrypted_message)
+
+    async def store_message(self, sender, recipient, content, **options):
+        """Awaitable SecureMessenger.store_message"""
+        return await self.run_db(self.messenger.store_message, sender, recipient, content, **options)
+
+    async def get_conversation(self, contact, limit=50, before=None):
+        """Awaitable SecureMessenger.get_conversation"""
+        return await self.run_db(self.messenger.get_conversation, contact, limit, before)
+
+    async def flush(self):
+        """Wait until queued messages are durably stored"""
+        return await self.run_db(self.messenger.flush)
+
+    async def close(self):
+        """Finish outstanding work, stop the pools and close the messenger"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._crypto.shutdown)
+        await loop.run_in_executor(None, self._db.shutdown)
+        await loop.run_in_executor(None, self.messenger.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger Benchmarks
+Micro-benchmarks for the secure_messenger crypto and storage paths
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from secure_messenger import SecureMessenger
+
+WORDS = ("secure private message enclave key session cipher network peer local "
+         "chat hello status update meeting tomorrow server client packet").split()
+
+OPERATIONS = ['encrypt_message', 'decrypt_message', 'decrypt_bytes', 'store_message', 'get_conversation']
+
+# Settings that change what a benchmark measures; a baseline must match them
+CONFIG_META = ['key_backend', 'session_mode', 'compression', 'sizes', 'db_sizes',
+               'store_size', 'page_size', 'contacts']
+
+
+def make_message(rng, size):
+    """Chat-like text of roughly ``size`` bytes"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(operation, inputs, warmup):
+    """Time ``operation`` once per input and summarise the latencies"""
+    for item in inputs[:warmup]:
+        operation(item)
+
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        begin = time.perf_counter_ns()
+        operation(item)
+        latencies.append(time.perf_counter_ns() - begin)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'iterations': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) / 1e6,
+        'p50_ms': percentile(latencies, 0.50) / 1e6,
+        'p99_ms': percentile(latencies, 0.99) / 1e6,
+    }
+
+
+def measure_allocations(operation, inputs):
+    """Mean bytes allocated at peak per call, traced with tracemalloc"""
+    tracemalloc.start()
+    try:
+        total = 0
+        for item in inputs:
+            tracemalloc.clear_traces()
+            baseline = tracemalloc.get_traced_memory()[0]
+            operation(item)
+            total += tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return total / len(inputs) if inputs else 0.0
+
+
+class BenchmarkSuite:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.results = {}
+        self.work_dir = tempfile.mkdtemp(prefix="enclave_bench_")
+
+        messenger_options = {
+            'session_mode': args.session_mode,
+            'key_backend': args.key_backend,
+            'compression': not args.no_compression,
+        }
+        self.alice = SecureMessenger("alice", os.path.join(self.work_dir, "alice"), **messenger_options)
+        self.bob = SecureMessenger("bob", os.path.join(self.work_dir, "bob"), **messenger_options)
+        self.alice.accept_key_exchange(self.bob.get_key_exchange_payload())
+        self.bob.accept_key_exchange(self.alice.get_key_exchange_payload())
+
+    def record(self, operation, params, stats):
+        name = operation + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+        self.results[name] = {'operation': operation, 'params': params, **stats}
+        allocations = f"  alloc {stats['alloc_kb']:>8.1f} KiB" if 'alloc_kb' in stats else ""
+        print(f"  {name:<45} {stats['ops_per_sec']:>10.1f} ops/s"
+              f"  p50 {stats['p50_ms']:>8.3f} ms  p99 {stats['p99_ms']:>8.3f} ms{allocations}")
+
+    def wanted(self, operation):
+        return operation in self.args.operations
+
+    def run_crypto(self):
+        iterations, warmup = self.args.iterations, self.args.warmup
+
+        for size in self.args.sizes:
+            messages = [make_message(self.rng, size) for _ in range(iterations)]
+
+            if self.wanted('encrypt_message'):
+                stats = measure(lambda text: self.alice.encrypt_message("bob", text), messages, warmup)
+                self.record('encrypt_message', {'size': size}, stats)
+
+            if self.wanted('decrypt_message'):
+                # Fresh envelopes in order, so ratchet receivers never see replays
+                envelopes = [self.alice.encrypt_message("bob", text) for text in messages]
+                stats = measure(self.bob.decrypt_message, envelopes, 0)
+                envelopes = [self.alice.encrypt_message("bob", text) for text in messages]
+                stats['alloc_kb'] = measure_allocations(self.bob.decrypt_message, envelopes) / 1024
+                self.record('decrypt_message', {'size': size}, stats)
+
+            if self.wanted('decrypt_bytes'):
+                # Binary envelopes as they arrive off the wire; the text is never decoded
+                envelopes = [memoryview(self.alice.encrypt_message("bob", text, envelope_format='binary'))
+                             for text in messages]
+                stats = measure(self.bob.decrypt_bytes, envelopes, 0)
+                envelopes = [memoryview(self.alice.encrypt_message("bob", text, envelope_format='binary'))
+                             for text in messages]
+                stats['alloc_kb'] = measure_allocations(self.bob.decrypt_bytes, envelopes) / 1024
+                self.record('decrypt_bytes', {'size': size}, stats)
+
+    def populate(self, target):
+        """Grow bob's database to ``target`` messages spread over several contacts"""
+        stored = self.bob.get_stats()['total_messages']
+        now = time.time()
+        contacts = ["alice"] + [f"peer{i}" for i in range(self.args.contacts - 1)]
+
+        while stored < target:
+            batch = []
+            for index in range(stored, min(target, stored + 10000)):
+                contact = contacts[index % len(contacts)]
+                outgoing = index % 2 == 0
+                batch.append({
+                    'sender': "bob" if outgoing else contact,
+                    'recipient': contact if outgoing else "bob",
+                    'content': make_message(self.rng, self.args.store_size),
+                    'timestamp': now - (target - index),
+                })
+            self.bob.store_messages(batch)
+            stored += len(batch)
+
+    def run_storage(self):
+        iterations, warmup = self.args.iterations, self.args.warmup
+
+        for db_size in sorted(self.args.db_sizes):
+            print(f"🗄️  Populating database to {db_size} messages...")
+            self.populate(db_size)
+
+            if self.wanted('store_message'):
+                for size in self.args.sizes:
+                    contents = [make_message(self.rng, size) for _ in range(iterations)]
+                    stats = measure(lambda text: self.bob.store_message("alice", "bob", text),
+                                    contents, warmup)
+                    self.record('store_message', {'db_size': db_size, 'size': size}, stats)
+
+            if self.wanted('get_conversation'):
+                stats = measure(lambda _: self.bob.get_conversation("alice", limit=self.args.page_size),
+                                range(iterations), warmup)
+                self.record('get_conversation', {'db_size': db_size, 'limit': self.args.page_size}, stats)
+
+    def run(self):
+        print(f"⏱️  Enclave benchmarks ({self.args.key_backend}, "
+              f"{'session' if self.args.session_mode else 'hybrid'} mode, "
+              f"{self.args.iterations} iterations)")
+        try:
+            self.run_crypto()
+            self.run_storage()
+        finally:
+            self.alice.close()
+            self.bob.close()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        return {
+            'meta': {
+                'created_at': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                **config_meta(self.args),
+                'iterations': self.args.iterations,
+            },
+            'results': self.results,
+        }
+
+
+def config_meta(args):
+    """The CONFIG_META settings of a run"""
+    return {
+        'key_backend': args.key_backend,
+        'session_mode': args.session_mode,
+        'compression': not args.no_compression,
+        'sizes': args.sizes,
+        'db_sizes': args.db_sizes,
+        'store_size': args.store_size,
+        'page_size': args.page_size,
+        'contacts': args.contacts,
+    }
+
+
+def config_mismatches(meta, baseline_meta):
+    """``(setting, ours, baseline's)`` for every CONFIG_META setting that differs"""
+    return [(key, meta[key], baseline_meta.get(key, 'not recorded'))
+            for key in CONFIG_META if baseline_meta.get(key) != meta[key]]
+
+
+def compare(report, baseline, ops_threshold, p99_threshold):
+    """Print the change against a baseline report; returns the regressed benchmarks"""
+    regressions = []
+    print(f"\n📊 Comparison with baseline from {baseline['meta'].get('created_at', 'unknown')}:")
+
+    for name, current in report['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous:
+            print(f"  {name:<45} (new)")
+            continue
+
+        ops_change = (current['ops_per_sec'] - previous['ops_per_sec']) / previous['ops_per_sec'] * 100
+        p99_change = (current['p99_ms'] - previous['p99_ms']) / previous['p99_ms'] * 100
+        regressed = ops_change < -ops_threshold or p99_change > p99_threshold
+        marker = "❌" if regressed else "✅"
+        print(f"  {marker} {name:<43} ops/s {ops_change:+7.1f}%  p99 {p99_change:+7.1f}%")
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+
+def parse_sizes(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enclave Messenger benchmarks')
+    parser.add_argument('--operations', type=lambda text: text.split(","), default=OPERATIONS,
+                        help=f"Comma-separated subset of {','.join(OPERATIONS)}")
+    parser.add_argument('--sizes', type=parse_sizes, default=[64, 1024, 16384],
+                        help='Message sizes in bytes (default: 64,1024,16384)')
+    parser.add_argument('--db-sizes', type=parse_sizes, default=[0, 10000, 100000],
+                        help='Database sizes to populate for storage benchmarks')
+    parser.add_argument('--iterations', type=int, default=200, help='Timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed calls before each benchmark')
+    parser.add_argument('--contacts', type=int, default=10, help='Contacts in the synthetic history')
+    parser.add_argument('--store-size', type=int, default=256, help='Message size used to populate databases')
+    parser.add_argument('--page-size', type=int, default=50, help='get_conversation page size')
+    parser.add_argument('--key-backend', choices=['rsa', 'x25519'], default='rsa')
+    parser.add_argument('--session-mode', action='store_true', help='Benchmark ratchet sessions')
+    parser.add_argument('--no-compression', action='store_true', help='Disable payload compression')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for synthetic messages')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare against a previous --output file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed ops/sec drop in percent before failing (default: 10)')
+    parser.add_argument('--p99-threshold', type=float, default=25.0,
+                        help='Allowed p99 latency increase in percent before failing (default: 25)')
+    args = parser.parse_args()
+
+    unknown = set(args.operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"unknown operations: {', '.join(sorted(unknown))}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Refuse before spending time on a run that could not be compared
+        mismatches = config_mismatches(config_meta(args), baseline['meta'])
+        if mismatches:
+            print(f"❌ {args.baseline} was recorded with different settings:")
+            for key, ours, theirs in mismatches:
+                print(f"   {key}: {ours} here, {theirs} in the baseline")
+            print("   Re-run with matching settings or record a new baseline")
+            sys.exit(2)
+
+    report = BenchmarkSuite(args).run()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Results written to {args.output}")
+
+    if baseline:
+        regressions = compare(report, baseline, args.threshold, args.p99_threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} benchmark(s) regressed beyond the thresholds")
+            sys.exit(1)
+        print("\n✅ No regressions beyond the thresholds")
+
+
+if __name__ == "__main__":
+    main()
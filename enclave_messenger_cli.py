@@ -6,7 +6,8 @@ import threading
 import socket
 import argparse
 from datetime import datetime
-from secure_messenger import SecureMessenger
+from secure_messenger import SecureMessenger, envelope_from_transport, envelope_to_transport
+from json_stream import JsonStreamDecoder
 
 DISCOVERY_PORT = 37020
 DISCOVERY_BROADCAST = '<broadcast>'
@@ -15,23 +16,29 @@ DISCOVERY_RESPONSE = 'ENCLAVE_MESSENGER_RESPONSE'
 DISCOVERY_TIMEOUT = 5
 
 class EnclaveMessengerCLI:
-    def __init__(self, username, port=12345, host=None, discovery_only=False):
+    def __init__(self, username, port=12345, host=None, discovery_only=False, key_backend='rsa'):
         self.username = username
         self.port = port
         self.host = host
         self.discovery_only = discovery_only
-        self.messenger = SecureMessenger(username)
+        self.messenger = SecureMessenger(username, write_behind=True, session_mode=True,
+                                         binary_envelopes=True, key_backend=key_backend,
+                                         maintenance_interval=600, metrics=True)
 
         # Network components
         self.server_socket = None
         self.client_socket = None
         self.connections = {}
+        self.synced_peers = set()
+        self.send_lock = threading.Lock()
         self.is_server = host is None and not discovery_only
         self.is_running = True
 
         # UI state
         self.current_contact = None
         self.contacts = []
+        self.history_contact = None
+        self.history_cursor = None
 
         if self.discovery_only:
             print(f"🔎 Searching for Enclave Messenger users on the local network as {username}...")
@@ -164,13 +171,15 @@ class EnclaveMessengerCLI:
 
                 print(f"🟢 Connected to {self.host}:{self.port}")
 
+                decoder = JsonStreamDecoder()
                 while self.is_running:
                     try:
-                        data = self.client_socket.recv(4096)
+                        data = self.client_socket.recv(65536)
                         if not data:
                             break
 
-                        self.process_received_data(data.decode(), "server")
+                        for item in decoder.feed(data):
+                            self.process_received_data(item, "server")
 
                     except Exception as e:
                         if self.is_running:
@@ -185,13 +194,15 @@ class EnclaveMessengerCLI:
         time.sleep(1)
 
     def handle_client(self, client_socket, client_id):
+        decoder = JsonStreamDecoder()
         try:
             while self.is_running:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(65536)
                 if not data:
                     break
 
-                self.process_received_data(data.decode(), client_id)
+                for item in decoder.feed(data):
+                    self.process_received_data(item, client_id)
 
         except Exception as e:
             print(f"❌ Client {client_id} error: {e}")
@@ -199,82 +210,127 @@ class EnclaveMessengerCLI:
             client_socket.close()
             if client_id in self.connections:
                 del self.connections[client_id]
+            self.synced_peers.discard(client_id)
             print(f"📡 Client {client_id} disconnected")
 
-    def process_received_data(self, data, sender_id):
+    def process_received_data(self, message_data, sender_id):
         try:
-            message_data = json.loads(data)
+            if isinstance(message_data, str):
+                print(f"\n📨 {sender_id}: {message_data}")
+                self.show_prompt()
+                return
 
             if message_data.get('type') == 'key_exchange':
-                sender_username = message_data['username']
-                public_key = message_data['public_key']
-
-                self.messenger.add_contact(sender_username, public_key)
-                print(f"🔑 Added public key for {sender_username}")
+                sender_username, changed = self.messenger.accept_key_exchange(message_data)
+                if changed:
+                    print(f"🔑 Added public key for {sender_username}")
 
                 if sender_username not in self.contacts:
                     self.contacts.append(sender_username)
 
-                self.send_public_key(sender_id)
+                # Answer new keys and the first exchange on a connection; answering
+                # repeats of a known key would bounce key exchanges back and forth
+                first_exchange = sender_id not in self.synced_peers
+                if changed or first_exchange:
+                    self.send_public_key(sender_id)
+
+                # Once per connection, ask peers that can answer for anything
+                # we missed while away
+                if first_exchange:
+                    self.synced_peers.add(sender_id)
+                    if self.messenger.peer_supports(sender_username, 'sync'):
+                        self.send_data(json.dumps(self.messenger.sync_request()), sender_id)
+
+            elif message_data.get('type') == 'sync_request':
+                # Stream from another thread so both sides can send at once
+                threading.Thread(target=self.send_sync_batches, args=(message_data, sender_id),
+                                 daemon=True).start()
+
+            elif message_data.get('type') == 'sync_batch':
+                result = self.messenger.ingest_sync_batch(message_data)
+                for decrypted in result['messages']:
+                    timestamp = datetime.fromtimestamp(decrypted['timestamp'])
+                    print(f"\n📥 [{timestamp.strftime('%Y-%m-%d %H:%M:%S')}] "
+                          f"{decrypted['sender']}: {decrypted['message']}")
+                if result['errors']:
+                    print(f"\n⚠️ {result['errors']} synced message(s) from {message_data['sender']} "
+                          f"could not be decrypted")
+                if message_data.get('final'):
+                    print(f"\n🔄 Caught up with {message_data['sender']}")
+                self.show_prompt()
 
             elif message_data.get('type') == 'encrypted_message':
-                encrypted_content = message_data['content']
-                decrypted = self.messenger.decrypt_message(encrypted_content)
+                encrypted_content = envelope_from_transport(message_data)
+                decrypted = self.messenger.decrypt_bytes(encrypted_content)
 
                 sender = decrypted['sender']
                 message = decrypted['message']
                 timestamp = datetime.fromtimestamp(decrypted['timestamp'])
 
-                self.messenger.store_message(sender, self.username, message)
+                if not self.messenger.store_message(sender, self.username, message,
+                                                    decrypted['encryption_method'],
+                                                    message_id=decrypted['message_id'],
+                                                    timestamp=decrypted['timestamp'],
+                                                    sequence=decrypted['sequence']):
+                    if self.messenger.is_past_replay_window(decrypted['timestamp']):
+                        print(f"\n⏰ Message from {sender} sent {timestamp.strftime('%Y-%m-%d %H:%M')} "
+                              f"is too old to check for replays and was not saved: {message}")
+                    else:
+                        print(f"\n🔁 Ignored replayed message from {sender}")
+                    self.show_prompt()
+                    return
+
                 print(f"\n📨 [{timestamp.strftime('%H:%M:%S')}] {sender}: {message}")
                 self.show_prompt()
 
-        except json.JSONDecodeError:
-            print(f"\n📨 {sender_id}: {data}")
-            self.show_prompt()
         except Exception as e:
             print(f"❌ Error processing message: {e}")
 
+    def send_sync_batches(self, request, target):
+        try:
+            for batch in self.messenger.sync_batches(request):
+                self.send_data(json.dumps(batch), target)
+        except Exception as e:
+            print(f"❌ Sync error: {e}")
+
     def send_public_key(self, target=None):
-        key_data = {
-            'type': 'key_exchange',
-            'username': self.username,
-            'public_key': self.messenger.get_public_key_pem()
-        }
+        key_data = self.messenger.get_key_exchange_payload()
 
         self.send_data(json.dumps(key_data), target)
 
     def send_data(self, data, target=None):
         try:
-            if self.is_server:
-                if target and target in self.connections:
-                    self.connections[target].send(data.encode())
+            # One frame at a time, so sync batches and chat cannot interleave
+            with self.send_lock:
+                if self.is_server:
+                    if target and target in self.connections:
+                        self.connections[target].sendall(data.encode())
+                    else:
+                        for conn in list(self.connections.values()):
+                            try:
+                                conn.sendall(data.encode())
+                            except:
+                                pass
                 else:
-                    for conn in list(self.connections.values()):
-                        try:
-                            conn.send(data.encode())
-                        except:
-                            pass
-            else:
-                if self.client_socket:
-                    self.client_socket.send(data.encode())
+                    if self.client_socket:
+                        self.client_socket.sendall(data.encode())
         except Exception as e:
             print(f"❌ Send error: {e}")
 
     def send_message(self, message, recipient=None):
         try:
             if recipient and recipient in self.contacts:
-                encrypted_msg = self.messenger.encrypt_message(recipient, message)
+                # Encrypts and stores our copy under the same message id
+                encrypted_msg = self.messenger.seal_message(recipient, message)
 
                 message_data = {
                     'type': 'encrypted_message',
-                    'content': encrypted_msg,
-                    'recipient': recipient
+                    'recipient': recipient,
+                    **envelope_to_transport(encrypted_msg)
                 }
 
                 self.send_data(json.dumps(message_data))
 
-                self.messenger.store_message(self.username, recipient, message)
                 timestamp = datetime.now().strftime('%H:%M:%S')
                 print(f"[{timestamp}] You -> {recipient}: {message}")
 
@@ -310,7 +366,9 @@ Key Management:
   
 Conversation:
   /history [contact]      - Show message history
-  /export <contact>       - Export conversation to file
+  /more                   - Show older messages from the last /history
+  /search <words>         - Search all conversations
+  /export <contact> [jsonl] [gz] - Export conversation to file
   /clear                  - Clear screen
   
 System:
@@ -344,20 +402,35 @@ Example Usage:
             print(f"  {i}. {trust_indicator} {contact}")
         print()
 
-    def show_history(self, contact=None):
-        target_contact = contact or self.current_contact
+    def show_history(self, contact=None, older=False):
+        if older:
+            target_contact = self.history_contact
+            if not target_contact or not self.history_cursor:
+                print("❌ Use /history first")
+                return
+        else:
+            target_contact = contact or self.current_contact
 
         if not target_contact:
             print("❌ No contact specified")
             return
 
-        messages = self.messenger.get_conversation(target_contact, limit=20)
+        before = self.history_cursor if older else None
+        messages = self.messenger.get_conversation(target_contact, limit=20, before=before)
 
         if not messages:
-            print(f"📭 No conversation history with {target_contact}")
+            if older:
+                print(f"📭 No older messages with {target_contact}")
+            else:
+                print(f"📭 No conversation history with {target_contact}")
             return
 
-        print(f"\n📜 Conversation with {target_contact} (last 20 messages):")
+        # Remember where this page starts so /more can continue from it
+        self.history_contact = target_contact
+        self.history_cursor = (messages[0]['timestamp'], messages[0]['id'])
+
+        label = "older messages" if older else "last 20 messages"
+        print(f"\n📜 Conversation with {target_contact} ({label}):")
         print("=" * 50)
 
         for msg in messages:
@@ -367,6 +440,24 @@ Example Usage:
             print(f"[{timestamp}] {sender}: {content}")
         print("=" * 50)
 
+    def search_messages(self, query):
+        try:
+            results = self.messenger.search_messages(query, limit=20)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return
+
+        if not results:
+            print(f"🔍 No messages matching '{query}'")
+            return
+
+        print(f"\n🔍 Messages matching '{query}' (newest first):")
+        print("=" * 50)
+        for msg in results:
+            timestamp = datetime.fromtimestamp(msg['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"[{timestamp}] {msg['sender']} -> {msg['recipient']}: {msg['content']}")
+        print("=" * 50)
+
     def show_status(self):
         mode = "Server" if self.is_server else "Client"
         connections_count = len(self.connections) if self.is_server else (1 if self.client_socket else 0)
@@ -385,63 +476,58 @@ Example Usage:
 
     def show_stats(self):
         try:
-            import sqlite3
-            conn = sqlite3.connect(self.messenger.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            total_messages = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM messages WHERE sender = ?", (self.username,))
-            sent_messages = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM messages WHERE recipient = ?", (self.username,))
-            received_messages = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(DISTINCT sender) FROM messages WHERE sender != ?", (self.username,))
-            unique_contacts = cursor.fetchone()[0]
-
-            conn.close()
+            stats = self.messenger.get_stats()
 
             print(f"\n📈 Statistics:")
-            print(f"📨 Total Messages: {total_messages}")
-            print(f"📤 Sent: {sent_messages}")
-            print(f"📥 Received: {received_messages}")
-            print(f"👥 Unique Contacts: {unique_contacts}")
-            print(f"🔒 Encryption: Hybrid (RSA-2048 + AES-GCM)")
+            print(f"📨 Total Messages: {stats['total_messages']}")
+            print(f"📤 Sent: {stats['sent']}")
+            print(f"📥 Received: {stats['received']}")
+            print(f"👥 Unique Contacts: {stats['contacts']}")
+            for day, counts in stats['per_day'].items():
+                print(f"📅 {day}: {counts['sent']} sent, {counts['received']} received")
+            session = 'ratchet sessions' if self.messenger.session_mode else 'per-message keys'
+            print(f"🔒 Encryption: {self.messenger.key_backend.label} + AES-GCM, {session}")
+
+            timings = self.messenger.get_metrics()
+            if timings:
+                print(f"\n⏱️  Timings:")
+                for stage, timing in timings.items():
+                    print(f"   {stage:<20} {timing['count']:>7} calls  "
+                          f"p50 {timing['p50_ms']:8.3f} ms  p99 {timing['p99_ms']:8.3f} ms")
             print()
 
         except Exception as e:
             print(f"❌ Stats error: {e}")
 
-    def export_conversation(self, contact):
-        if not contact:
+    def export_conversation(self, args):
+        parts = args.split()
+        if not parts:
             print("❌ No contact specified")
             return
 
-        messages = self.messenger.get_conversation(contact)
-
-        if not messages:
-            print(f"📭 No messages to export for {contact}")
-            return
+        contact, options = parts[0], parts[1:]
+        fmt = 'jsonl' if 'jsonl' in options else 'text'
+        extension = 'jsonl' if fmt == 'jsonl' else 'txt'
+        if 'gz' in options:
+            extension += '.gz'
+        filename = f"chat_{self.username}_{contact}_{int(time.time())}.{extension}"
 
-        filename = f"chat_{self.username}_{contact}_{int(time.time())}.txt"
+        def report(done, total):
+            print(f"\r💾 Exporting... {done}/{total}", end='', flush=True)
 
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(f"Enclave Messenger Chat Export\n")
-                f.write(f"Participants: {self.username} <-> {contact}\n")
-                f.write(f"Exported: {datetime.now()}\n")
-                f.write("=" * 60 + "\n\n")
+            count = self.messenger.export_conversation(contact, filename, progress=report)
+            print()
 
-                for msg in messages:
-                    timestamp = datetime.fromtimestamp(msg['timestamp'])
-                    f.write(f"[{timestamp}] {msg['sender']}: {msg['content']}\n")
+            if not count:
+                os.remove(filename)
+                print(f"📭 No messages to export for {contact}")
+                return
 
-            print(f"💾 Conversation exported to: {filename}")
+            print(f"💾 {count} messages exported to: {filename}")
 
         except Exception as e:
-            print(f"❌ Export failed: {e}")
+            print(f"\n❌ Export failed: {e}")
 
     def handle_easter_eggs(self, command):
         if command == "/joke":
@@ -543,6 +629,10 @@ Example Usage:
                     elif command == "/history":
                         contact = args if args else None
                         self.show_history(contact)
+                    elif command == "/more":
+                        self.show_history(older=True)
+                    elif command == "/search" and args:
+                        self.search_messages(args)
                     elif command == "/export" and args:
                         self.export_conversation(args)
                     elif command in ["/joke", "/ascii", "/matrix", "/boom"]:
@@ -568,6 +658,8 @@ Example Usage:
         except:
             pass
 
+        self.messenger.close()
+
 
 def main():
     parser = argparse.ArgumentParser(description='Enclave Messenger CLI')
@@ -575,10 +667,13 @@ def main():
     parser.add_argument('--host', help='Server IP address (client mode)')
     parser.add_argument('--port', type=int, default=12345, help='Port number')
     parser.add_argument('-s', '--search', action='store_true', help='Search for users on the local network')
+    parser.add_argument('--key-backend', choices=['rsa', 'x25519'], default='rsa',
+                        help='Key type to generate for a new user (x25519 is much faster)')
     args = parser.parse_args()
 
     try:
-        cli = EnclaveMessengerCLI(args.username, args.port, args.host, discovery_only=args.search)
+        cli = EnclaveMessengerCLI(args.username, args.port, args.host, discovery_only=args.search,
+                                  key_backend=args.key_backend)
         cli.start()
     except KeyboardInterrupt:
         print("\n👋 Goodbye!")
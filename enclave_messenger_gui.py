@@ -14,7 +14,8 @@ import os
 import sys
 import random
 import webbrowser
-from secure_messenger import SecureMessenger
+from secure_messenger import SecureMessenger, envelope_from_transport, envelope_to_transport
+from json_stream import JsonStreamDecoder
 
 
 class EnclaveMessengerGUI:
@@ -33,9 +34,12 @@ class EnclaveMessengerGUI:
         self.server_socket = None
         self.client_socket = None
         self.connections = {}
+        self.synced_peers = set()
+        self.send_lock = threading.Lock()
         self.is_server = False
         self.is_connected = False
         self.current_contact = None
+        self.history_cursor = None
 
         # Easter egg variables
         self.konami_sequence = ['Up', 'Up', 'Down', 'Down', 'Left', 'Right', 'Left', 'Right', 'b', 'a']
@@ -175,7 +179,8 @@ class EnclaveMessengerGUI:
 
         # Initialize secure messenger
         try:
-            self.messenger = SecureMessenger(username)
+            self.messenger = SecureMessenger(username, write_behind=True, session_mode=True,
+                                             binary_envelopes=True, maintenance_interval=600)
             messagebox.showinfo("Success", f"Secure keys generated for {username}")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to initialize encryption: {str(e)}")
@@ -252,18 +257,19 @@ class EnclaveMessengerGUI:
         client_id = f"{addr[0]}:{addr[1]}"
         self.connections[client_id] = client_socket
 
+        decoder = JsonStreamDecoder()
         try:
             while True:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(65536)
                 if not data:
                     break
 
-                try:
-                    message_data = json.loads(data.decode())
-                    self.process_received_message(message_data, client_id)
-                except json.JSONDecodeError:
-                    # Handle plain text for backward compatibility
-                    self.log_message(f"📨 {client_id}: {data.decode()}")
+                for item in decoder.feed(data):
+                    if isinstance(item, str):
+                        # Handle plain text for backward compatibility
+                        self.log_message(f"📨 {client_id}: {item}")
+                    else:
+                        self.process_received_message(item, client_id)
 
         except Exception as e:
             self.log_message(f"❌ Client {client_id} error: {str(e)}")
@@ -271,22 +277,24 @@ class EnclaveMessengerGUI:
             client_socket.close()
             if client_id in self.connections:
                 del self.connections[client_id]
+            self.synced_peers.discard(client_id)
             self.log_message(f"📡 Client {client_id} disconnected")
 
     def handle_server_messages(self):
         """Handle messages from server when in client mode"""
+        decoder = JsonStreamDecoder()
         try:
             while self.is_connected:
-                data = self.client_socket.recv(4096)
+                data = self.client_socket.recv(65536)
                 if not data:
                     break
 
-                try:
-                    message_data = json.loads(data.decode())
-                    self.process_received_message(message_data, "server")
-                except json.JSONDecodeError:
-                    # Handle plain text
-                    self.log_message(f"📨 Server: {data.decode()}")
+                for item in decoder.feed(data):
+                    if isinstance(item, str):
+                        # Handle plain text
+                        self.log_message(f"📨 Server: {item}")
+                    else:
+                        self.process_received_message(item, "server")
 
         except Exception as e:
             self.log_message(f"❌ Server connection error: {str(e)}")
@@ -297,26 +305,61 @@ class EnclaveMessengerGUI:
         try:
             if message_data.get('type') == 'key_exchange':
                 # Handle public key exchange
-                sender_username = message_data['username']
-                public_key = message_data['public_key']
-
-                self.messenger.add_contact(sender_username, public_key)
-                self.log_message(f"🔑 Added public key for {sender_username}")
-
-                # Send our public key back
-                self.send_public_key(sender_id)
+                sender_username, changed = self.messenger.accept_key_exchange(message_data)
+                if changed:
+                    self.log_message(f"🔑 Added public key for {sender_username}")
+
+                # Send our public key back, unless this only repeated a key we
+                # already had on this connection (replying would ping-pong forever)
+                first_exchange = sender_id not in self.synced_peers
+                if changed or first_exchange:
+                    self.send_public_key(sender_id)
+
+                # Once per connection, ask peers that can answer for anything
+                # we missed while away
+                if first_exchange:
+                    self.synced_peers.add(sender_id)
+                    if self.messenger.peer_supports(sender_username, 'sync'):
+                        self.send_data(json.dumps(self.messenger.sync_request()), sender_id)
+
+            elif message_data.get('type') == 'sync_request':
+                # Stream from another thread so both sides can send at once
+                threading.Thread(target=self.send_sync_batches, args=(message_data, sender_id),
+                                 daemon=True).start()
+
+            elif message_data.get('type') == 'sync_batch':
+                # Missed messages, stored in one transaction
+                result = self.messenger.ingest_sync_batch(message_data)
+                for decrypted in result['messages']:
+                    self.display_message(decrypted['sender'], decrypted['message'],
+                                         datetime.fromtimestamp(decrypted['timestamp']))
+                if result['errors']:
+                    self.log_message(f"⚠️ {result['errors']} synced message(s) from "
+                                     f"{message_data['sender']} could not be decrypted")
+                if message_data.get('final'):
+                    self.log_message(f"🔄 Caught up with {message_data['sender']}")
 
             elif message_data.get('type') == 'encrypted_message':
                 # Handle encrypted message
-                encrypted_content = message_data['content']
+                encrypted_content = envelope_from_transport(message_data)
                 decrypted = self.messenger.decrypt_message(encrypted_content)
 
                 sender = decrypted['sender']
                 message = decrypted['message']
                 timestamp = datetime.fromtimestamp(decrypted['timestamp'])
 
-                # Store message
-                self.messenger.store_message(sender, self.username, message)
+                # Store message, dropping replays and messages too old to check
+                if not self.messenger.store_message(sender, self.username, message,
+                                                    decrypted['encryption_method'],
+                                                    message_id=decrypted['message_id'],
+                                                    timestamp=decrypted['timestamp'],
+                                                    sequence=decrypted['sequence']):
+                    if self.messenger.is_past_replay_window(decrypted['timestamp']):
+                        self.log_message(f"⏰ Message from {sender} sent {timestamp.strftime('%Y-%m-%d %H:%M')} "
+                                         f"is too old to check for replays and was not saved: {message}")
+                    else:
+                        self.log_message(f"🔁 Ignored replayed message from {sender}")
+                    return
 
                 # Display message
                 self.display_message(sender, message, timestamp)
@@ -328,32 +371,38 @@ class EnclaveMessengerGUI:
         except Exception as e:
             self.log_message(f"❌ Error processing message: {str(e)}")
 
-    def send_public_key(self, target):
+    def send_sync_batches(self, request, target):
+        """Send a peer the messages it reported missing"""
+        try:
+            for batch in self.messenger.sync_batches(request):
+                self.send_data(json.dumps(batch), target)
+        except Exception as e:
+            self.log_message(f"❌ Sync error: {str(e)}")
+
+    def send_public_key(self, target=None):
         """Send public key to establish secure communication"""
-        key_data = {
-            'type': 'key_exchange',
-            'username': self.username,
-            'public_key': self.messenger.get_public_key_pem()
-        }
+        key_data = self.messenger.get_key_exchange_payload()
 
         self.send_data(json.dumps(key_data), target)
 
     def send_data(self, data, target=None):
         """Send data to target or all connections"""
         try:
-            if self.is_server:
-                if target and target in self.connections:
-                    self.connections[target].send(data.encode())
+            # One frame at a time, so sync batches and chat cannot interleave
+            with self.send_lock:
+                if self.is_server:
+                    if target and target in self.connections:
+                        self.connections[target].sendall(data.encode())
+                    else:
+                        # Broadcast to all connections
+                        for conn in list(self.connections.values()):
+                            try:
+                                conn.sendall(data.encode())
+                            except:
+                                pass
                 else:
-                    # Broadcast to all connections
-                    for conn in self.connections.values():
-                        try:
-                            conn.send(data.encode())
-                        except:
-                            pass
-            else:
-                if self.client_socket and self.is_connected:
-                    self.client_socket.send(data.encode())
+                    if self.client_socket and self.is_connected:
+                        self.client_socket.sendall(data.encode())
         except Exception as e:
             self.log_message(f"❌ Send error: {str(e)}")
 
@@ -397,6 +446,8 @@ class EnclaveMessengerGUI:
                   command=self.show_stats).pack(fill=tk.X, pady=2)
         ttk.Button(controls_frame, text="💾 Export Chat", 
                   command=self.export_chat).pack(fill=tk.X, pady=2)
+        ttk.Button(controls_frame, text="📜 Older Messages", 
+                  command=self.load_older_messages).pack(fill=tk.X, pady=2)
 
         # Right panel - Chat area
         right_panel = ttk.Frame(main_container)
@@ -448,6 +499,7 @@ class EnclaveMessengerGUI:
             return
 
         messages = self.messenger.get_conversation(self.current_contact)
+        self.history_cursor = (messages[0]['timestamp'], messages[0]['id']) if messages else None
 
         self.chat_display.config(state='normal')
         self.chat_display.delete(1.0, tk.END)
@@ -462,6 +514,31 @@ class EnclaveMessengerGUI:
         self.chat_display.config(state='disabled')
         self.chat_display.see(tk.END)
 
+    def load_older_messages(self):
+        """Prepend the page of history preceding the oldest message shown"""
+        if not self.current_contact or not self.history_cursor:
+            self.log_message("📭 No older messages")
+            return
+
+        messages = self.messenger.get_conversation(self.current_contact, before=self.history_cursor)
+        if not messages:
+            self.history_cursor = None
+            self.log_message("📭 No older messages")
+            return
+
+        self.history_cursor = (messages[0]['timestamp'], messages[0]['id'])
+
+        older_text = ''.join(
+            f"[{datetime.fromtimestamp(msg['timestamp']).strftime('%H:%M:%S')}] "
+            f"{msg['sender']}: {msg['content']}\n"
+            for msg in messages
+        )
+
+        self.chat_display.config(state='normal')
+        self.chat_display.insert('1.0', older_text)
+        self.chat_display.config(state='disabled')
+        self.chat_display.see('1.0')
+
     def initiate_key_exchange(self):
         """Initiate key exchange with all connected clients"""
         self.send_public_key()
@@ -483,18 +560,18 @@ class EnclaveMessengerGUI:
         try:
             if self.current_contact:
                 # Send to specific contact
-                encrypted_msg = self.messenger.encrypt_message(self.current_contact, message)
+                # Encrypts and stores our copy under the same message id
+                encrypted_msg = self.messenger.seal_message(self.current_contact, message)
 
                 message_data = {
                     'type': 'encrypted_message',
-                    'content': encrypted_msg,
-                    'recipient': self.current_contact
+                    'recipient': self.current_contact,
+                    **envelope_to_transport(encrypted_msg)
                 }
 
                 self.send_data(json.dumps(message_data))
 
-                # Store and display locally
-                self.messenger.store_message(self.username, self.current_contact, message)
+                # Display locally
                 self.display_message(self.username, message, datetime.now())
 
             else:
@@ -523,6 +600,7 @@ class EnclaveMessengerGUI:
 /stats - Show statistics
 /clear - Clear chat
 /konami - Show Konami code status
+/search <words> - Search message history
             """
             self.log_message(help_text)
 
@@ -563,6 +641,26 @@ class EnclaveMessengerGUI:
         elif cmd == '/konami':
             self.log_message(f"🎮 Konami progress: {len(self.user_sequence)}/10")
 
+        elif cmd.startswith('/search '):
+            self.search_messages(command[len('/search '):].strip())
+
+    def search_messages(self, query):
+        """Search stored messages, within the current chat if one is open"""
+        try:
+            results = self.messenger.search_messages(query, contact=self.current_contact, limit=20)
+        except ValueError as e:
+            self.log_message(f"❌ {str(e)}")
+            return
+
+        if not results:
+            self.log_message(f"🔍 No messages matching '{query}'")
+            return
+
+        self.log_message(f"🔍 {len(results)} message(s) matching '{query}':")
+        for msg in results:
+            timestamp = datetime.fromtimestamp(msg['timestamp'])
+            self.display_message(msg['sender'], msg['content'], timestamp)
+
     def emoji_explosion(self):
         """Create emoji explosion effect"""
         emojis = ['💥', '✨', '🔥', '💣', '⚡', '🌟', '💫', '🎆']
@@ -591,27 +689,17 @@ class EnclaveMessengerGUI:
 
     def show_stats(self):
         """Show messenger statistics"""
-        # Count messages
         try:
-            import sqlite3
-            conn = sqlite3.connect(self.messenger.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            total_messages = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(DISTINCT sender) FROM messages WHERE sender != ?", (self.username,))
-            contacts_count = cursor.fetchone()[0]
-
-            conn.close()
+            counts = self.messenger.get_stats()
+            session = 'ratchet sessions' if self.messenger.session_mode else 'per-message keys'
 
             stats = f"""
 📊 Enclave Messenger Statistics:
 👤 Username: {self.username}
-📨 Total Messages: {total_messages}
-👥 Active Contacts: {contacts_count}
+📨 Total Messages: {counts['total_messages']} ({counts['sent']} sent, {counts['received']} received)
+👥 Active Contacts: {counts['contacts']}
 🔌 Connection Mode: {'Server' if self.is_server else 'Client'}
-🔒 Encryption: Hybrid (RSA + AES-GCM)
+🔒 Encryption: {self.messenger.key_backend.label} + AES-GCM, {session}
 ⏰ Session Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
             """
             self.log_message(stats)
@@ -620,33 +708,37 @@ class EnclaveMessengerGUI:
             self.log_message(f"❌ Stats error: {str(e)}")
 
     def export_chat(self):
-        """Export chat history"""
-        try:
-            filename = filedialog.asksaveasfilename(
-                defaultextension=".txt",
-                filetypes=[("Text files", "*.txt"), ("JSON files", "*.json")]
-            )
-
-            if filename:
-                if self.current_contact:
-                    messages = self.messenger.get_conversation(self.current_contact)
-
-                    with open(filename, 'w', encoding='utf-8') as f:
-                        f.write(f"Enclave Messenger Chat Export\n")
-                        f.write(f"Participants: {self.username} <-> {self.current_contact}\n")
-                        f.write(f"Exported: {datetime.now()}\n")
-                        f.write("="*50 + "\n\n")
-
-                        for msg in messages:
-                            timestamp = datetime.fromtimestamp(msg['timestamp'])
-                            f.write(f"[{timestamp}] {msg['sender']}: {msg['content']}\n")
-
-                    self.log_message(f"💾 Chat exported to {filename}")
-                else:
-                    self.log_message("❌ Select a contact first")
+        """Export chat history in the background"""
+        if not self.current_contact:
+            self.log_message("❌ Select a contact first")
+            return
+
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[("Text files", "*.txt"), ("JSON Lines", "*.jsonl"),
+                       ("Compressed text", "*.txt.gz"), ("Compressed JSON Lines", "*.jsonl.gz")]
+        )
+        if not filename:
+            return
 
+        contact = self.current_contact
+        self.log_message(f"💾 Exporting chat with {contact}...")
+        threading.Thread(target=self._export_chat_worker, args=(contact, filename),
+                         daemon=True).start()
+
+    def _export_chat_worker(self, contact, filename):
+        """Stream the export off the Tk thread, reporting back via after()"""
+        def report(done, total):
+            self.root.after(0, lambda: self.status_bar.config(
+                text=f"💾 Exporting {done}/{total}"))
+
+        try:
+            count = self.messenger.export_conversation(contact, filename, progress=report)
+            self.root.after(0, self.log_message, f"💾 Exported {count} messages to {filename}")
         except Exception as e:
-            self.log_message(f"❌ Export error: {str(e)}")
+            self.root.after(0, self.log_message, f"❌ Export error: {str(e)}")
+        finally:
+            self.root.after(0, lambda: self.status_bar.config(text="🟢 Ready"))
 
     def track_konami_keys(self, event):
         """Track Konami code key sequence"""
@@ -720,6 +812,9 @@ class EnclaveMessengerGUI:
         except:
             pass
 
+        if self.messenger:
+            self.messenger.close()
+
         self.root.destroy()
 
     def run(self):
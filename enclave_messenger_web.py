@@ -11,6 +11,8 @@ import time
 import secrets
 from datetime import datetime
 from secure_messenger import SecureMessenger
+from metrics import MetricsRegistry
+from key_pool import KeyPool
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(16)
@@ -19,6 +21,8 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 # Global state
 users = {}  # username -> {messenger, sid, rooms}
 rooms = {}  # room_id -> {users, created_at}
+metrics = MetricsRegistry()  # stage timings shared by every user's messenger
+key_pool = KeyPool('rsa', depth=16, metrics=metrics)  # keys for new users, made ahead of time
 
 
 @app.route('/')
@@ -34,6 +38,8 @@ def health():
         'status': 'healthy',
         'active_users': len(users),
         'active_rooms': len(rooms),
+        'metrics': metrics.snapshot(),
+        'key_pool': key_pool.stats(),
         'timestamp': time.time()
     })
 
@@ -53,6 +59,7 @@ def on_disconnect():
         if user_data['sid'] == request.sid:
             print(f"User {username} disconnected")
             del users[username]
+            user_data['messenger'].close()
             # Notify others in rooms
             for room_id in user_data.get('rooms', []):
                 emit('user_left', {'username': username}, room=room_id)
@@ -73,8 +80,8 @@ def on_register(data):
         return
 
     try:
-        # Initialize secure messenger
-        messenger = SecureMessenger(username)
+        # Initialize secure messenger; new keys come from the pool
+        messenger = SecureMessenger(username, metrics=metrics, key_pool=key_pool)
 
         # Store user data
         users[username] = {
@@ -184,6 +191,9 @@ Enclave Messenger Web Commands:
 
 
 if __name__ == '__main__':
+    # Fill the key pool before the first sign-up
+    key_pool.start()
+
     # Create templates directory if it doesn't exist
     os.makedirs('templates', exist_ok=True)
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - JSON stream framing
+Splits a socket byte stream into back-to-back JSON frames
+"""
+
+import re
+import json
+import codecs
+
+STREAM_MAX_BUFFER = 64 * 1024 * 1024  # undecodable socket input beyond this is dropped
+
+# Frame structure for JsonStreamDecoder's brace tracking
+STREAM_STRUCTURE = re.compile(r'[{}"\\]')
+# What a truncated frame can end in: part of a number, literal or \u escape
+STREAM_PARTIAL_TOKEN = re.compile(
+    r'[-+.\deE]*|t(r(ue?)?)?|f(a(l(se?)?)?)?|n(u(ll?)?)?|N(aN?)?'
+    r'|-?I(n(f(i(n(i(ty?)?)?)?)?)?)?|u[0-9a-fA-F]{0,4}'
+)
+STREAM_REPARSE_LIMIT = 64 * 1024  # larger pending frames are parsed only once their braces balance
+
+
+class JsonStreamDecoder:
+    """Split a socket byte stream into JSON frames
+
+    Frames are JSON objects written back to back, so several may arrive in
+    one recv() and one may span several. Text between frames is passed
+    through for peers that send plain messages, and a ``{`` that does not
+    start a valid frame is passed through as text up to the next ``{``.
+    """
+
+    def __init__(self, max_buffer=STREAM_MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')('replace')
+        self._buffer = ''
+        self._reset_scan()
+
+    def _reset_scan(self):
+        self._scanned = 0
+        self._depth = 0
+        self._in_string = False
+
+    def _braces_balanced(self):
+        """Track nesting of the pending frame over new input only"""
+        buffer = self._buffer
+        position = self._scanned
+        while True:
+            match = STREAM_STRUCTURE.search(buffer, position)
+            if match is None:
+                self._scanned = len(buffer)
+                return False
+            char, position = match.group(), match.end()
+            if char == '\\':
+                if position == len(buffer):
+                    # Escaped character not received yet: look at the backslash again
+                    self._scanned = position - 1
+                    return False
+                position += 1
+            elif char == '"':
+                self._in_string = not self._in_string
+            elif not self._in_string:
+                self._depth += 1 if char == '{' else -1
+                if self._depth == 0:
+                    self._scanned = position
+                    return True
+
+    @staticmethod
+    def _truncated(buffer, error):
+        """Whether a parse error only means the frame has not fully arrived"""
+        if error.msg.startswith('Unterminated string'):
+            return True
+        return STREAM_PARTIAL_TOKEN.fullmatch(buffer[error.pos:]) is not None
+
+    def _pass_text(self, items, end):
+        text = self._buffer[:end].strip()
+        if text:
+            items.append(text)
+        self._buffer = self._buffer[end:]
+        self._reset_scan()
+
+    def feed(self, data):
+        """Add received bytes; returns the complete frames (dicts) and text chunks"""
+        self._buffer += self._text.decode(data)
+        items = []
+        while self._buffer:
+            start = self._buffer.find('{')
+            if start < 0:
+                self._pass_text(items, len(self._buffer))
+                break
+            if start > 0:
+                self._pass_text(items, start)
+                continue
+
+            balanced = self._braces_balanced()
+            if not balanced and len(self._buffer) > self.max_buffer:
+                self._buffer = ''
+                self._reset_scan()
+                raise ValueError("Dropped oversized frame")
+            if not balanced and len(self._buffer) > STREAM_REPARSE_LIMIT:
+                # Re-parsing a large frame on every recv() is quadratic; wait for its end
+                break
+
+            try:
+                item, end = self._decoder.raw_decode(self._buffer)
+            except json.JSONDecodeError as e:
+                if not balanced and self._truncated(self._buffer, e):
+                    break
+                # Not a frame after all: hand it over as text and resync at the next '{'
+                next_frame = self._buffer.find('{', 1)
+                self._pass_text(items, next_frame if next_frame > 0 else len(self._buffer))
+                continue
+
+            items.append(item)
+            self._buffer = self._buffer[end:]
+            self._reset_scan()
+        return items
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - Key pool
+Key pairs generated ahead of time in worker processes
+"""
+
+import os
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from cryptography.hazmat.primitives import serialization
+from secure_messenger import KEY_BACKENDS
+from metrics import NULL_METRICS
+
+DEFAULT_POOL_DEPTH = 8
+
+
+def _generate_key_der(backend_name):
+    """Worker: a fresh private key as PKCS8 DER (key objects cannot be pickled)"""
+    private_key = KEY_BACKENDS[backend_name].generate_private_key()
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+class KeyPool:
+    """Keeps ``depth`` key pairs ready so new users never wait for keygen
+
+    A filler thread tops the pool up in worker processes whenever keys
+    are taken. take() hands out a ready key, or waits for one already
+    being generated when a burst drains the pool; only a broken pool
+    falls back to generating inline. Pass it to SecureMessenger as
+    ``key_pool``.
+    """
+
+    def __init__(self, key_backend='rsa', depth=DEFAULT_POOL_DEPTH, workers=None, metrics=None):
+        if key_backend not in KEY_BACKENDS:
+            raise ValueError(f"Unknown key backend: {key_backend}")
+        self.key_backend = key_backend
+        self.depth = depth
+        self.workers = workers or min(depth, os.cpu_count() or 1)
+        self.metrics = metrics or NULL_METRICS
+
+        self._keys = deque()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._in_flight = 0
+        self._closed = False
+        self._broken = False
+
+        self.generated = 0
+        self.served = 0
+        self.waits = 0
+        self.inline = 0
+
+    def start(self):
+        """Start the workers; called by the first take() if not done earlier"""
+        with self._cond:
+            if self._thread is not None or self._closed:
+                return
+            # Spawned workers: forking a threaded server process is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            self._thread = threading.Thread(target=self._fill, name="enclave-keypool", daemon=True)
+            self._thread.start()
+
+    def _fill(self):
+        pending = set()
+        try:
+            while True:
+                with self._cond:
+                    while not self._closed and not pending and len(self._keys) >= self.depth:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    deficit = self.depth - len(self._keys) - len(pending)
+
+                for _ in range(deficit):
+                    pending.add(self._executor.submit(_generate_key_der, self.key_backend))
+                with self._cond:
+                    self._in_flight = len(pending)
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                with self._cond:
+                    for future in done:
+                        self._keys.append(future.result())
+                        self.generated += 1
+                    self._in_flight = len(pending)
+                    self._cond.notify_all()
+        except Exception:
+            # Broken worker pool: take() generates inline from now on
+            with self._cond:
+                self._broken = True
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def take(self, timeout=None):
+        """Return a private key, waiting at most ``timeout`` seconds for the pool"""
+        self.start()
+        with self.metrics.time('keypool_take'):
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._cond:
+                if not self._keys:
+                    self.waits += 1
+                while not self._keys and not self._broken and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                key_der = self._keys.popleft() if self._keys else None
+                if key_der is None:
+                    self.inline += 1
+                else:
+                    self.served += 1
+                self._cond.notify_all()
+
+            if key_der is None:
+                return KEY_BACKENDS[self.key_backend].generate_private_key()
+            # Our own workers made the key, so skip the RSA consistency check:
+            # it costs about as much as generating the key
+            return serialization.load_der_private_key(key_der, password=None,
+                                                      unsafe_skip_rsa_key_validation=True)
+
+    def stats(self):
+        """Pool depth and how keys were handed out"""
+        with self._cond:
+            return {
+                'key_backend': self.key_backend,
+                'depth': len(self._keys),
+                'target_depth': self.depth,
+                'in_flight': self._in_flight,
+                'generated': self.generated,
+                'served': self.served,
+                'waits': self.waits,
+                'inline': self.inline,
+                'broken': self._broken
+            }
+
+    def close(self):
+        """Stop refilling and shut the workers down; pooled keys are discarded"""
+        with self._cond:
+            self._closed = True
+            self._keys.clear()
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=False)
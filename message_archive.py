@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - Message archive
+Monthly, compressed cold storage for messages moved out of enclave.db
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+PARTITION_PREFIX = 'messages-'
+PARTITION_SUFFIX = '.db'
+ARCHIVE_COMPRESSION_LEVEL = 9
+ARCHIVE_MAX_OPEN = 16           # partition connections kept open
+
+# Archived rows keep their enclave.db id, so (timestamp, id) cursors stay valid
+ARCHIVE_COLUMNS = ("id, conversation, sender, recipient, content, compressed, timestamp, "
+                   "message_type, encryption_method, message_id, sequence")
+
+
+def partition_for(timestamp):
+    """Partition name ('YYYY-MM', UTC) holding messages sent at ``timestamp``"""
+    return time.strftime('%Y-%m', time.gmtime(timestamp))
+
+
+class MessageArchive:
+    """A directory of per-month SQLite files with compressed message content
+
+    Each partition is a small standalone database with its own
+    conversation index, so old months can be backed up once and left
+    alone. Content is zlib-compressed per row when that saves space.
+    """
+
+    def __init__(self, directory, max_open=ARCHIVE_MAX_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+
+        self._connections = OrderedDict()   # partition -> connection, least recent first
+        self._lock = threading.RLock()
+
+    def path(self, partition):
+        return os.path.join(self.directory, f"{PARTITION_PREFIX}{partition}{PARTITION_SUFFIX}")
+
+    def _connection(self, partition):
+        conn = self._connections.get(partition)
+        if conn is not None:
+            self._connections.move_to_end(partition)
+            return conn
+
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.path(partition), check_same_thread=False)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                conversation TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                content BLOB NOT NULL,
+                compressed INTEGER NOT NULL DEFAULT 0,
+                timestamp REAL NOT NULL,
+                message_type TEXT,
+                encryption_method TEXT NOT NULL,
+                message_id TEXT,
+                sequence INTEGER
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_archive_conversation
+            ON messages (conversation, timestamp, id)
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_archive_sequence
+            ON messages (conversation, sender, sequence) WHERE sequence IS NOT NULL
+        """)
+        conn.commit()
+
+        self._connections[partition] = conn
+        while len(self._connections) > self.max_open:
+            self._connections.popitem(last=False)[1].close()
+        return conn
+
+    def write(self, partition, rows):
+        """Store ``(id, conversation, sender, recipient, content, timestamp, message_type,
+        encryption_method, message_id, sequence)`` rows in one transaction
+
+        Rows already archived are skipped, so an interrupted move can be
+        repeated safely.
+        """
+        encoded = []
+        for row in rows:
+            content = row[4].encode()
+            packed = zlib.compress(content, ARCHIVE_COMPRESSION_LEVEL)
+            compressed = len(packed) < len(content)
+            encoded.append(row[:4] + (packed if compressed else content, int(compressed)) + row[5:])
+
+        with self._lock:
+            conn = self._connection(partition)
+            with conn:
+                conn.executemany(f"""
+                    INSERT OR IGNORE INTO messages ({ARCHIVE_COLUMNS})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, encoded)
+
+    @staticmethod
+    def _message(row):
+        content = zlib.decompress(row[4]) if row[5] else row[4]
+        return {
+            'id': row[0],
+            'sender': row[2],
+            'recipient': row[3],
+            'content': content.decode(),
+            'timestamp': row[6],
+            'encryption_method': row[8],
+            'message_id': row[9],
+            'sequence': row[10]
+        }
+
+    def _query(self, partition, where, params, order, limit):
+        with self._lock:
+            rows = self._connection(partition).execute(f"""
+                SELECT {ARCHIVE_COLUMNS} FROM messages
+                WHERE {where} ORDER BY {order} LIMIT ?
+            """, tuple(params) + (limit,)).fetchall()
+        return [self._message(row) for row in rows]
+
+    def page(self, partition, conversation, limit, before=None):
+        """Up to ``limit`` messages of a conversation preceding ``before``, newest first"""
+        if before is None:
+            return self._query(partition, "conversation = ?", (conversation,),
+                               "timestamp DESC, id DESC", limit)
+        before_timestamp, before_id = before
+        return self._query(partition, "conversation = ? AND timestamp <= ? AND (timestamp < ? OR id < ?)",
+                           (conversation, before_timestamp, before_timestamp, before_id),
+                           "timestamp DESC, id DESC", limit)
+
+    def iter_conversation(self, partition, conversation, chunk_size=1000):
+        """Yield a conversation's messages in one partition, oldest first"""
+        last_timestamp, last_id = float('-inf'), -1
+        while True:
+            messages = self._query(partition, "conversation = ? AND timestamp >= ? AND (timestamp > ? OR id > ?)",
+                                   (conversation, last_timestamp, last_timestamp, last_id),
+                                   "timestamp, id", chunk_size)
+            yield from messages
+            if len(messages) < chunk_size:
+                return
+            last_timestamp, last_id = messages[-1]['timestamp'], messages[-1]['id']
+
+    def message_ids(self, partition, conversation, start, stop):
+        """Message ids of a conversation with ``start <= timestamp < stop``"""
+        with self._lock:
+            return [row[0] for row in self._connection(partition).execute("""
+                SELECT message_id FROM messages
+                WHERE conversation = ? AND timestamp >= ? AND timestamp < ?
+                  AND message_id IS NOT NULL
+            """, (conversation, start, stop))]
+
+    def after_sequence(self, partition, conversation, sender, sequence):
+        """A sender's messages in a conversation with a higher sequence, lowest first"""
+        return self._query(partition, "conversation = ? AND sender = ? AND sequence > ?",
+                           (conversation, sender, sequence), "sequence", -1)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - Segmented message log
+Append-only message storage for high-ingest deployments
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import bisect
+import shutil
+import sqlite3
+import struct
+import argparse
+import threading
+
+# Record: header | conversation key | JSON body. The header holds the body
+# length, CRC32 of conversation + body, message id, id of the previous message
+# in the same conversation (0 for the first), timestamp and key length.
+RECORD_HEADER = struct.Struct('>IIQQdH')
+
+SEGMENT_SUFFIX = '.log'
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 1024   # bytes between sparse id -> offset entries
+DEFAULT_BLOCK_SIZE = 64         # conversation messages between sparse marks
+
+
+class Segment:
+    """One segment file with a sparse id -> offset index and a lazy read map"""
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.first_id = None
+        self.last_id = None
+        self.max_timestamp = 0.0
+        self.size = 0
+        self.count = 0
+        self.index_ids = []
+        self.index_offsets = []
+
+        self._file = None
+        self._map = None
+        self._mapped = 0
+
+    def add(self, record_id, timestamp, offset, length, interval):
+        """Account for a record written at ``offset``"""
+        if self.first_id is None:
+            self.first_id = record_id
+        self.last_id = record_id
+        self.max_timestamp = max(self.max_timestamp, timestamp)
+        if not self.index_offsets or offset - self.index_offsets[-1] >= interval:
+            self.index_ids.append(record_id)
+            self.index_offsets.append(offset)
+        self.size = offset + length
+        self.count += 1
+
+    def _ensure_mapped(self, end):
+        if end <= self._mapped:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = len(self._map)
+        if end > self._mapped:
+            raise ValueError(f"Segment {self.path} is shorter than its index")
+
+    def header(self, offset):
+        self._ensure_mapped(offset + RECORD_HEADER.size)
+        return RECORD_HEADER.unpack_from(self._map, offset)
+
+    def read(self, offset, length):
+        self._ensure_mapped(offset + length)
+        return self._map[offset:offset + length]
+
+    def locate(self, record_id):
+        """Offset of ``record_id`` in this segment, or None"""
+        position = bisect.bisect_right(self.index_ids, record_id) - 1
+        if position < 0:
+            return None
+
+        offset = self.index_offsets[position]
+        while offset < self.size:
+            body_length, _crc, current_id, _prev, _timestamp, key_length = self.header(offset)
+            if current_id == record_id:
+                return offset
+            if current_id > record_id:
+                return None
+            offset += RECORD_HEADER.size + key_length + body_length
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._mapped = 0
+
+
+class _Conversation:
+    __slots__ = ('tail', 'count', 'marks', 'newest', 'ordered')
+
+    def __init__(self):
+        self.tail = 0         # id of the newest message
+        self.count = 0        # messages appended since the log was opened or rebuilt
+        self.marks = []       # ids of every block_size-th message, ascending
+        self.newest = 0.0     # timestamp of the tail message
+        self.ordered = True   # timestamps never went backwards along the ids
+
+
+class MessageLog:
+    """Append-only, segmented message store
+
+    Messages are appended to the active segment in one write per batch.
+    Each record links back to the previous message of its conversation, so
+    history is read by following links from the conversation's newest
+    message through memory-mapped segments. A sparse per-segment index
+    resolves a message id to its offset, and a sparse per-conversation list
+    of marks lets cursors and full exports start mid-history.
+
+    Sealed segments are immutable: compact() drops expired segments whole
+    and concatenates runs of small ones, which is safe because records
+    refer to each other by id rather than by position. Indexes live in
+    memory and are rebuilt from the segment headers on open; a torn record
+    at the end of the last segment is truncated away.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 index_interval=DEFAULT_INDEX_INTERVAL, block_size=DEFAULT_BLOCK_SIZE, sync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.block_size = block_size
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        self._first_ids = []
+        self.conversations = {}
+        self.last_id = 0
+        self._lock = threading.RLock()
+        self._writer = None
+
+        self._load()
+
+    # --- opening -----------------------------------------------------------
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{number:010d}{SEGMENT_SUFFIX}")
+
+    def _load(self):
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+        for position, number in enumerate(numbers):
+            segment = Segment(self._segment_path(number), number)
+            last = position == len(numbers) - 1
+            if not self._scan(segment, verify=last):
+                # Leftover of an interrupted merge: its records are already
+                # in the merged segment before it
+                segment.close()
+                os.remove(segment.path)
+                continue
+            self.segments.append(segment)
+
+        # Each process appends to a fresh segment; compact() merges small ones
+        if self.segments and self.segments[-1].size == 0:
+            active = self.segments[-1]
+        else:
+            number = self.segments[-1].number + 1 if self.segments else 1
+            active = Segment(self._segment_path(number), number)
+            self.segments.append(active)
+        self._open_writer(active)
+        self._reindex_segments()
+
+    def _scan(self, segment, verify):
+        """Index every record of a segment; False if it duplicates earlier ones"""
+        size = os.path.getsize(segment.path)
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            body_length, crc, record_id, _prev, timestamp, key_length = segment.header(offset)
+            end = offset + RECORD_HEADER.size + key_length + body_length
+            if end > size:
+                break
+            if offset == 0 and record_id <= self.last_id:
+                return False
+            if record_id <= self.last_id:
+                raise ValueError(f"Corrupt segment {segment.path}: ids out of order")
+
+            key = segment.read(offset + RECORD_HEADER.size, key_length)
+            if verify and zlib.crc32(segment.read(offset + RECORD_HEADER.size,
+                                                  key_length + body_length)) != crc:
+                break
+            self._index_record(segment, record_id, timestamp, key.decode(), offset, end - offset)
+            offset = end
+
+        if offset < size:
+            if not verify:
+                raise ValueError(f"Corrupt segment {segment.path} at offset {offset}")
+            # Torn write at the tail of the active segment
+            segment.close()
+            os.truncate(segment.path, offset)
+        return True
+
+    def _index_record(self, segment, record_id, timestamp, conversation, offset, length):
+        segment.add(record_id, timestamp, offset, length, self.index_interval)
+
+        state = self.conversations.get(conversation)
+        if state is None:
+            state = self.conversations[conversation] = _Conversation()
+        if state.count % self.block_size == 0:
+            state.marks.append(record_id)
+        if state.count and timestamp < state.newest:
+            state.ordered = False
+        state.newest = timestamp
+        state.tail = record_id
+        state.count += 1
+
+        self.last_id = record_id
+
+    def _reindex_segments(self):
+        self._first_ids = [segment.first_id if segment.first_id is not None else self.last_id + 1
+                           for segment in self.segments]
+
+    def _open_writer(self, segment):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = open(segment.path, 'ab')
+        self.active = segment
+
+    def _roll(self):
+        """Seal the active segment and start the next one"""
+        number = self.active.number + 1
+        segment = Segment(self._segment_path(number), number)
+        self.segments.append(segment)
+        self._open_writer(segment)
+
+    # --- writing -----------------------------------------------------------
+
+    def append(self, rows, ids=None):
+        """Append ``(sender, recipient, content, timestamp, method, message_id, sequence, conversation)`` rows
+
+        Ids are assigned sequentially unless ``ids`` gives increasing ids,
+        e.g. to keep those of migrated messages. Returns the ids used.
+        """
+        with self._lock:
+            buffer = bytearray()
+            assigned = []
+
+            for position, row in enumerate(rows):
+                sender, recipient, content, timestamp, method, message_id, sequence, conversation = row
+                record_id = ids[position] if ids else self.last_id + 1
+                if record_id <= self.last_id:
+                    raise ValueError(f"Message id {record_id} is not after {self.last_id}")
+
+                key = conversation.encode()
+                body = json.dumps({
+                    'sender': sender,
+                    'recipient': recipient,
+                    'content': content,
+                    'encryption_method': method,
+                    'message_id': message_id,
+                    'sequence': sequence
+                }, separators=(',', ':')).encode()
+                state = self.conversations.get(conversation)
+                payload = key + body
+                record = RECORD_HEADER.pack(len(body), zlib.crc32(payload), record_id,
+                                            state.tail if state else 0, timestamp, len(key)) + payload
+
+                if self.active.size + len(record) > self.segment_size and self.active.size:
+                    self._write(buffer)
+                    buffer = bytearray()
+                    self._roll()
+
+                self._index_record(self.active, record_id, timestamp, conversation,
+                                   self.active.size, len(record))
+                buffer += record
+                assigned.append(record_id)
+
+            self._write(buffer)
+            self._reindex_segments()
+            return assigned
+
+    def _write(self, buffer):
+        if not buffer:
+            return
+        self._writer.write(buffer)
+        self._writer.flush()
+        if self.sync:
+            os.fsync(self._writer.fileno())
+
+    # --- reading -----------------------------------------------------------
+
+    def _read(self, record_id):
+        """Return ``(message dict, previous id)`` or None if not stored"""
+        position = bisect.bisect_right(self._first_ids, record_id) - 1
+        if position < 0:
+            return None
+        segment = self.segments[position]
+        if segment.last_id is None or record_id > segment.last_id:
+            return None
+        offset = segment.locate(record_id)
+        if offset is None:
+            return None
+
+        body_length, _crc, _id, prev, timestamp, key_length = segment.header(offset)
+        body = json.loads(segment.read(offset + RECORD_HEADER.size + key_length, body_length).decode())
+        body['id'] = record_id
+        body['timestamp'] = timestamp
+        body.setdefault('sequence', None)
+        return body, prev
+
+    def _walk(self, start, lower, upper):
+        """Messages with ``lower <= id < upper``, newest first, from ``start`` backwards"""
+        messages = []
+        record_id = start
+        while record_id and record_id >= lower:
+            found = self._read(record_id)
+            if found is None:
+                # Older history was dropped by retention
+                break
+            message, record_id = found
+            if message['id'] < upper:
+                messages.append(message)
+        return messages
+
+    def _key(self, record_id):
+        message, _prev = self._read(record_id)
+        return message['timestamp'], record_id
+
+    def page(self, conversation, limit=50, before=None):
+        """Newest ``limit`` messages of a conversation, oldest first
+
+        Messages are ordered by ``(timestamp, id)`` like the SQLite store, and
+        ``before=(timestamp, id)`` continues from an earlier page. While a
+        conversation's timestamps rise with its ids the page is one walk back
+        from the nearest mark; once an older message was appended late (e.g.
+        a synced backlog) the conversation is read whole and sorted.
+        """
+        before = tuple(before) if before is not None else None
+        with self._lock:
+            state = self.conversations.get(conversation)
+            if state is None:
+                return []
+
+            if not state.ordered:
+                messages = self._walk(state.tail, 0, float('inf'))
+                if before is not None:
+                    messages = [message for message in messages
+                                if (message['timestamp'], message['id']) < before]
+                messages.sort(key=lambda message: (message['timestamp'], message['id']))
+                return messages[max(len(messages) - limit, 0):]
+
+            start = state.tail
+            if before is not None:
+                # Start at the first mark not below the cursor: at most one block to skip
+                low, high = 0, len(state.marks)
+                while low < high:
+                    middle = (low + high) // 2
+                    if self._key(state.marks[middle]) < before:
+                        low = middle + 1
+                    else:
+                        high = middle
+                if low < len(state.marks):
+                    start = state.marks[low]
+
+            messages = []
+            record_id = start
+            while record_id and len(messages) < limit:
+                found = self._read(record_id)
+                if found is None:
+                    # Older history was dropped by retention
+                    break
+                message, record_id = found
+                if before is None or (message['timestamp'], message['id']) < before:
+                    messages.append(message)
+        messages.reverse()
+        return messages
+
+    def iter_conversation(self, conversation):
+        """Yield a conversation oldest first, one mark-to-mark block at a time"""
+        with self._lock:
+            state = self.conversations.get(conversation)
+            if state is None:
+                return
+            marks, tail = list(state.marks), state.tail
+
+        # Lower and upper id bounds of each block; the first covers anything
+        # left before the oldest mark after retention
+        bounds = zip([0] + marks, marks + [None])
+        for lower, upper in bounds:
+            with self._lock:
+                if upper is None:
+                    block = self._walk(tail, lower, float('inf'))
+                else:
+                    block = self._walk(upper, lower, upper)
+            block.reverse()
+            yield from block
+
+    def iter_after(self, record_id):
+        """Yield ``(conversation, message)`` for every record after ``record_id``, in id order"""
+        with self._lock:
+            segments = list(self.segments)
+        for segment in segments:
+            with self._lock:
+                if segment.last_id is None or segment.last_id <= record_id:
+                    continue
+                position = bisect.bisect_right(segment.index_ids, record_id) - 1
+                offset = segment.index_offsets[position] if position >= 0 else 0
+                records = []
+                while offset < segment.size:
+                    body_length, _crc, current_id, _prev, timestamp, key_length = segment.header(offset)
+                    start = offset + RECORD_HEADER.size
+                    offset = start + key_length + body_length
+                    if current_id <= record_id:
+                        continue
+                    message = json.loads(segment.read(start + key_length, body_length).decode())
+                    message['id'] = current_id
+                    message['timestamp'] = timestamp
+                    message.setdefault('sequence', None)
+                    records.append((segment.read(start, key_length).decode(), message))
+            yield from records
+
+    # --- maintenance -------------------------------------------------------
+
+    def compact(self, retention=None):
+        """Drop expired sealed segments and merge runs of small ones
+
+        With ``retention`` (seconds), sealed segments whose newest message is
+        older than that are deleted whole. Adjacent sealed segments that fit
+        together within segment_size are then concatenated into one file.
+        Returns counts of expired and merged segments.
+        """
+        expired = self._expire(retention) if retention else 0
+
+        merged = 0
+        with self._lock:
+            sealed = self.segments[:-1]
+        run, run_size = [], 0
+        for segment in sealed + [None]:
+            if segment is not None and run_size + segment.size <= self.segment_size:
+                run.append(segment)
+                run_size += segment.size
+                continue
+            if len(run) > 1:
+                self._merge(run)
+                merged += len(run) - 1
+            run, run_size = ([segment], segment.size) if segment is not None else ([], 0)
+
+        return {'expired': expired, 'merged': merged}
+
+    def _expire(self, retention):
+        cutoff = time.time() - retention
+        with self._lock:
+            expired = []
+            for segment in self.segments[:-1]:
+                if segment.max_timestamp >= cutoff:
+                    break
+                expired.append(segment)
+            if not expired:
+                return 0
+
+            self.segments = self.segments[len(expired):]
+            self._reindex_segments()
+            oldest = self.segments[0].first_id or self.last_id + 1
+
+            for conversation, state in list(self.conversations.items()):
+                if state.tail < oldest:
+                    del self.conversations[conversation]
+                else:
+                    state.marks = state.marks[bisect.bisect_left(state.marks, oldest):]
+
+            for segment in expired:
+                segment.close()
+                os.remove(segment.path)
+        return len(expired)
+
+    def _merge(self, run):
+        """Concatenate sealed segments into the first one's file"""
+        temp_path = f"{run[0].path}.merge"
+        with open(temp_path, 'wb') as dest:
+            for segment in run:
+                with open(segment.path, 'rb') as source:
+                    shutil.copyfileobj(source, dest)
+            dest.flush()
+            os.fsync(dest.fileno())
+
+        merged = Segment(run[0].path, run[0].number)
+        merged.first_id = run[0].first_id
+        merged.last_id = run[-1].last_id
+        base = 0
+        for segment in run:
+            merged.max_timestamp = max(merged.max_timestamp, segment.max_timestamp)
+            merged.count += segment.count
+            merged.index_ids.extend(segment.index_ids)
+            merged.index_offsets.extend(offset + base for offset in segment.index_offsets)
+            base += segment.size
+        merged.size = base
+
+        with self._lock:
+            os.replace(temp_path, merged.path)
+            start = self.segments.index(run[0])
+            self.segments[start:start + len(run)] = [merged]
+            self._reindex_segments()
+            for segment in run:
+                segment.close()
+            # Removing the rest last keeps a crash here recoverable: leftovers
+            # duplicate the merged ids and are discarded on open
+            for segment in run[1:]:
+                os.remove(segment.path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': sum(segment.size for segment in self.segments),
+                'messages': sum(segment.count for segment in self.segments),
+                'conversations': len(self.conversations),
+                'last_id': self.last_id
+            }
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for segment in self.segments:
+                segment.close()
+
+
+def migrate_database(db_path, log, batch_size=10000, progress=None):
+    """Copy every message of an enclave.db into ``log``, keeping message ids"""
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        message_id = "message_id" if "message_id" in columns else "NULL"
+        sequence = "sequence" if "sequence" in columns else "NULL"
+        # Databases SecureMessenger has not yet upgraded lack the conversation column
+        conversation = "conversation" if "conversation" in columns else (
+            "CASE WHEN sender < recipient THEN sender || char(31) || recipient "
+            "ELSE recipient || char(31) || sender END"
+        )
+
+        last_id, copied = 0, 0
+        while True:
+            rows = conn.execute(f"""
+                SELECT id, sender, recipient, content, timestamp, encryption_method,
+                       {message_id}, {sequence}, {conversation}
+                FROM messages WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                # Copied messages already have their stats and sync marks in
+                # SQLite, so the messenger must not redo them from the log
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'log_checkpoint'").fetchone():
+                    with conn:
+                        conn.execute("UPDATE log_checkpoint SET last_id = MAX(last_id, ?)", (log.last_id,))
+                return copied
+
+            new_rows = [row for row in rows if row[0] > log.last_id]
+            log.append([row[1:] for row in new_rows], ids=[row[0] for row in new_rows])
+            copied += len(new_rows)
+            last_id = rows[-1][0]
+            if progress:
+                progress(copied)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate an Enclave message database to a segment log')
+    parser.add_argument('data_dir', help='Directory holding enclave.db')
+    parser.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE,
+                        help='Maximum segment size in bytes')
+    args = parser.parse_args()
+
+    db_path = os.path.join(args.data_dir, "enclave.db")
+    if not os.path.exists(db_path):
+        print(f"❌ No database found at {db_path}")
+        sys.exit(1)
+
+    log = MessageLog(os.path.join(args.data_dir, "message_log"), segment_size=args.segment_size)
+    try:
+        copied = migrate_database(
+            db_path, log, progress=lambda done: print(f"\r📦 Migrated {done} messages", end='', flush=True)
+        )
+        stats = log.stats()
+    finally:
+        log.close()
+
+    print(f"\n✅ {copied} messages copied into {stats['segments']} segment(s). "
+          f"Open the messenger with storage='log' to use them.")
+
+
+if __name__ == "__main__":
+    main()
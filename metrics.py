@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Enclave Messenger - Metrics
+Per-stage call counts and latency histograms
+"""
+
+import time
+import bisect
+import threading
+
+# Latency histogram bucket upper bounds in seconds (10us .. 10s, then overflow)
+METRICS_BUCKETS = tuple(
+    scale * step for scale in (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1) for step in (1, 2.5, 5)
+) + (10.0, float('inf'))
+
+
+class _StageTimer:
+    __slots__ = ('registry', 'stage', 'started')
+
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.record(self.stage, time.perf_counter() - self.started, exc_type is not None)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class NullMetrics:
+    """Metrics sink that records nothing; the default, so timing costs one no-op"""
+
+    enabled = False
+    _timer = _NullTimer()
+
+    def time(self, stage):
+        return self._timer
+
+    def record(self, stage, seconds, failed=False):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsRegistry:
+    """Per-stage call counts and latency histograms
+
+    Use ``with registry.time('stage'):`` around the work to measure.
+    Listeners added with add_listener() are called as
+    ``listener(stage, seconds, failed)`` after every measurement, for
+    forwarding to an external metrics system. One registry can be shared
+    by several messengers.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._stages = {}   # stage -> [count, errors, total, max, bucket counts]
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def time(self, stage):
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds, failed=False):
+        bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0, 0.0, 0.0, [0] * len(METRICS_BUCKETS)]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += seconds
+            if seconds > entry[3]:
+                entry[3] = seconds
+            entry[4][bucket] += 1
+
+        for listener in self._listeners:
+            listener(stage, seconds, failed)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    @staticmethod
+    def _quantile(buckets, count, max_seconds, fraction):
+        """Upper bound of the bucket holding the given quantile"""
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, max_seconds)
+        return max_seconds
+
+    def snapshot(self):
+        """Counts, latency summary (ms) and non-empty histogram buckets per stage"""
+        with self._lock:
+            stages = {stage: (count, errors, total, maximum, list(buckets))
+                      for stage, (count, errors, total, maximum, buckets) in self._stages.items()}
+
+        snapshot = {}
+        for stage, (count, errors, total, maximum, buckets) in sorted(stages.items()):
+            snapshot[stage] = {
+                'count': count,
+                'errors': errors,
+                'total_ms': total * 1000,
+                'mean_ms': total / count * 1000,
+                'max_ms': maximum * 1000,
+                'p50_ms': self._quantile(buckets, count, maximum, 0.50) * 1000,
+                'p99_ms': self._quantile(buckets, count, maximum, 0.99) * 1000,
+                'histogram': {('inf' if bound == float('inf') else f"{bound * 1000:g}"): bucket_count
+                              for bound, bucket_count in zip(METRICS_BUCKETS, buckets) if bucket_count}
+            }
+        return snapshot
@@ -5,45 +5,1118 @@ Implements hybrid encryption with forward secrecy
 
 import os
 import json
+import math
 import base64
+import binascii
+import gzip
+import heapq
 import secrets
 import hashlib
+import hmac
+import mmap
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import queue
 import sqlite3
+import struct
+import threading
 import time
+import zlib
+from contextlib import contextmanager
+from message_log import MessageLog
+from metrics import MetricsRegistry, NULL_METRICS
+from message_archive import MessageArchive, partition_for
+
+try:
+    import zstandard
+except ImportError:  # optional: zlib is always available
+    zstandard = None
+
+# Separates the two participants in a conversation key; never valid in usernames
+CONVERSATION_SEPARATOR = '\x1f'
+
+# Wildcard for the contact/day columns of aggregate message_stats rows
+STATS_ALL = '*'
+
+
+# Ratchet session limits
+RATCHET_MAX_SKIP = 1000          # out-of-order message keys kept per session
+RATCHET_MAX_CHAIN = 100000       # refuse counters beyond this to bound work
+RATCHET_MAX_SESSIONS = 1024      # receiving sessions kept in memory
+
+# Replay detection
+REPLAY_WINDOW = 48 * 3600        # seconds a message id is remembered; older messages are refused
+REPLAY_CAPACITY = 100000         # ids per Bloom filter generation at the target error rate
+
+# Conversation digests: per-bucket sums of message id hashes, compared top-down
+DIGEST_BUCKET = 3600             # seconds covered by one leaf bucket
+DIGEST_SPAN = 1 << 20            # buckets in the root range (hours since 1970, ~119 years)
+DIGEST_FANOUT = 16               # sub-ranges per differing range and round trip
+DIGEST_LEAF_SIZE = 32            # ranges with fewer messages are compared id by id
+DIGEST_MODULUS = 1 << 128
+
+# Delta sync: each sender numbers its messages per conversation from 1
+SYNC_BATCH_SIZE = 64             # envelopes per sync_batch frame
+
+# Log storage: stats, seen ids, digests and sync marks are written to SQLite
+# in one transaction per batch of appended messages, replayed from the log
+# after a crash
+LOG_BOOKKEEPING_BATCH = 4096     # messages per bookkeeping transaction
+LOG_BOOKKEEPING_INTERVAL = 1.0   # seconds pending bookkeeping may wait
+
+# Payload compression, applied to the plaintext before AES-GCM
+COMPRESSION_THRESHOLD = 512              # smaller messages are sent as-is
+COMPRESSION_MAX_SIZE = 16 * 1024 * 1024  # refuse to inflate beyond this
+COMPRESSION_ALGORITHMS = ['zstd', 'zlib'] if zstandard else ['zlib']
+
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+
+class RSAKeyBackend:
+    """RSA-2048 key pairs with OAEP key wrapping (the original scheme)"""
+
+    name = 'rsa'
+    label = 'RSA-2048'
+    key_types = (rsa.RSAPrivateKey, rsa.RSAPublicKey)
+
+    def generate_private_key(self):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def wrap(self, public_key, key):
+        return public_key.encrypt(key, OAEP_PADDING)
+
+    def unwrap(self, private_key, wrapped_key):
+        return private_key.decrypt(bytes(wrapped_key), OAEP_PADDING)
+
+
+class X25519KeyBackend:
+    """ECIES-style wrapping: ephemeral X25519 agreement, HKDF-SHA256, AES-GCM
+
+    A wrapped key is ``ephemeral public key (32) | nonce (12) | AES-GCM(key)``.
+    """
+
+    name = 'x25519'
+    label = 'X25519'
+    key_types = (x25519.X25519PrivateKey, x25519.X25519PublicKey)
+
+    def generate_private_key(self):
+        return x25519.X25519PrivateKey.generate()
+
+    @staticmethod
+    def _derive_wrapping_key(shared_secret, ephemeral_public, recipient_public):
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=ephemeral_public + recipient_public,
+            info=b"enclave-x25519-wrap"
+        ).derive(shared_secret)
+
+    def wrap(self, public_key, key):
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_public = ephemeral.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        recipient_public = public_key.public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        wrapping_key = self._derive_wrapping_key(
+            ephemeral.exchange(public_key), ephemeral_public, recipient_public
+        )
+        nonce = os.urandom(12)
+        return ephemeral_public + nonce + AESGCM(wrapping_key).encrypt(nonce, key, None)
+
+    def unwrap(self, private_key, wrapped_key):
+        wrapped_key = bytes(wrapped_key)
+        ephemeral_public, nonce, ciphertext = wrapped_key[:32], wrapped_key[32:44], wrapped_key[44:]
+        recipient_public = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        shared_secret = private_key.exchange(
+            x25519.X25519PublicKey.from_public_bytes(ephemeral_public)
+        )
+        wrapping_key = self._derive_wrapping_key(shared_secret, ephemeral_public, recipient_public)
+        return AESGCM(wrapping_key).decrypt(nonce, ciphertext, None)
+
+
+KEY_BACKENDS = {backend.name: backend for backend in (RSAKeyBackend(), X25519KeyBackend())}
+
+
+def key_fingerprint(public_key):
+    """Short identifier for a public key, used as a recipient slot id"""
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).digest()[:8].hex()
+
+
+def key_backend_for(key):
+    """Return the key-agreement backend that handles ``key``"""
+    for backend in KEY_BACKENDS.values():
+        if isinstance(key, backend.key_types):
+            return backend
+    raise ValueError(f"Unsupported key type: {type(key).__name__}")
+
+
+# Binary envelope: fixed header followed by wrapped key, metadata and ciphertext
+ENVELOPE_MAGIC = b'EV'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>2sBBB16sI12sIH')
+ENVELOPE_FLAG_RATCHET = 0x01
+ENVELOPE_FLAG_MULTI = 0x02
+ENVELOPE_SLOT = struct.Struct('>8sBH')
+ENVELOPE_BACKEND_IDS = {'rsa': 0, 'x25519': 1}
+ENVELOPE_BACKEND_NAMES = {v: k for k, v in ENVELOPE_BACKEND_IDS.items()}
+
+# Fields carried base64-encoded in the JSON envelope
+ENVELOPE_BINARY_FIELDS = ('encrypted_key', 'nonce', 'ciphertext', 'metadata')
+ENVELOPE_MULTI_FIELDS = ('nonce', 'ciphertext', 'metadata')
+
+
+def pack_envelope(package):
+    """Serialize a package dict to the versioned binary envelope
+
+    Layout (big-endian): magic ``EV``, version, flags, key backend id,
+    16-byte key or session id, u32 ratchet counter, 12-byte nonce, u32
+    wrapped key length, u16 metadata length, then the wrapped key,
+    metadata (the AAD) and ciphertext. Multi-recipient envelopes replace
+    the wrapped key with a table of (8-byte slot, backend id, u16 length,
+    wrapped key) entries.
+    """
+    mode = package['mode']
+    if mode == 'ratchet':
+        flags, key_id, backend_id = ENVELOPE_FLAG_RATCHET, package['session_id'], package['key_backend']
+        wrapped = package['encrypted_key']
+    elif mode == 'multi':
+        flags, key_id, backend_id = ENVELOPE_FLAG_MULTI, package['key_id'], 'rsa'
+        wrapped = b''.join(
+            ENVELOPE_SLOT.pack(bytes.fromhex(slot), ENVELOPE_BACKEND_IDS[backend], len(wrapped_key))
+            + wrapped_key
+            for slot, (backend, wrapped_key) in package['recipients'].items()
+        )
+    else:
+        flags, key_id, backend_id = 0, package['key_id'], package['key_backend']
+        wrapped = package['encrypted_key']
+
+    header = ENVELOPE_HEADER.pack(
+        ENVELOPE_MAGIC,
+        ENVELOPE_VERSION,
+        flags,
+        ENVELOPE_BACKEND_IDS[backend_id],
+        bytes.fromhex(key_id),
+        package.get('counter', 0),
+        package['nonce'],
+        len(wrapped),
+        len(package['metadata'])
+    )
+    return b''.join((header, wrapped, package['metadata'], package['ciphertext']))
+
+
+def _unpack_recipient_table(view):
+    """Parse a multi-recipient key table into {slot: (backend, wrapped key)}"""
+    recipients = {}
+    offset = 0
+    while offset < len(view):
+        if offset + ENVELOPE_SLOT.size > len(view):
+            raise ValueError("Truncated recipient table")
+        slot, backend_id, length = ENVELOPE_SLOT.unpack_from(view, offset)
+        offset += ENVELOPE_SLOT.size
+        if backend_id not in ENVELOPE_BACKEND_NAMES or offset + length > len(view):
+            raise ValueError("Corrupt recipient table")
+        recipients[slot.hex()] = (ENVELOPE_BACKEND_NAMES[backend_id], view[offset:offset + length])
+        offset += length
+    return recipients
+
+
+def unpack_envelope(data):
+    """Parse a binary envelope without copying its payload
+
+    Byte fields in the returned package are memoryview slices of ``data``.
+    """
+    view = memoryview(data)
+    if len(view) < ENVELOPE_HEADER.size:
+        raise ValueError("Truncated envelope")
+
+    (magic, version, flags, backend_id, key_id, counter, nonce,
+     wrapped_length, metadata_length) = ENVELOPE_HEADER.unpack_from(view)
+    if magic != ENVELOPE_MAGIC:
+        raise ValueError("Not a binary envelope")
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version: {version}")
+    if backend_id not in ENVELOPE_BACKEND_NAMES:
+        raise ValueError(f"Unknown key backend id: {backend_id}")
+
+    offset = ENVELOPE_HEADER.size
+    metadata_offset = offset + wrapped_length
+    ciphertext_offset = metadata_offset + metadata_length
+    if ciphertext_offset > len(view):
+        raise ValueError("Truncated envelope")
+
+    package = {
+        'key_backend': ENVELOPE_BACKEND_NAMES[backend_id],
+        'nonce': nonce,
+        'metadata': view[metadata_offset:ciphertext_offset],
+        'ciphertext': view[ciphertext_offset:]
+    }
+    wrapped = view[offset:metadata_offset]
+    if flags & ENVELOPE_FLAG_MULTI:
+        package.update(mode='multi', key_id=key_id.hex(),
+                       recipients=_unpack_recipient_table(wrapped))
+    elif flags & ENVELOPE_FLAG_RATCHET:
+        package.update(mode='ratchet', session_id=key_id.hex(), counter=counter,
+                       encrypted_key=wrapped)
+    else:
+        package.update(mode='hybrid', key_id=key_id.hex(), encrypted_key=wrapped)
+    return package
+
+
+def encode_envelope(package, envelope_format='json'):
+    """Serialize a package dict as a JSON string or binary envelope"""
+    if envelope_format == 'binary':
+        return pack_envelope(package)
+    if envelope_format != 'json':
+        raise ValueError(f"Unknown envelope format: {envelope_format}")
+
+    if package['mode'] == 'multi':
+        encoded = {
+            'mode': 'multi',
+            'key_id': package['key_id'],
+            'recipients': {
+                slot: {'key_backend': backend, 'encrypted_key': base64.b64encode(wrapped_key).decode()}
+                for slot, (backend, wrapped_key) in package['recipients'].items()
+            }
+        }
+        for field in ENVELOPE_MULTI_FIELDS:
+            encoded[field] = base64.b64encode(package[field]).decode()
+        return json.dumps(encoded)
+
+    if package['mode'] == 'ratchet':
+        encoded = {
+            'mode': 'ratchet',
+            'session_id': package['session_id'],
+            'counter': package['counter']
+        }
+    else:
+        encoded = {'key_id': package['key_id']}
+
+    for field in ENVELOPE_BINARY_FIELDS:
+        encoded[field] = base64.b64encode(package[field]).decode()
+    if package['key_backend'] != 'rsa':
+        encoded['key_backend'] = package['key_backend']
+
+    return json.dumps(encoded)
+
+
+def decode_envelope(data):
+    """Parse either envelope format into a package dict"""
+    if isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == ENVELOPE_MAGIC:
+        return unpack_envelope(data)
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    encoded = json.loads(data)
+    package = {
+        'mode': encoded.get('mode', 'hybrid'),
+        'key_backend': encoded.get('key_backend', 'rsa')
+    }
+    if package['mode'] == 'multi':
+        package['key_id'] = encoded['key_id']
+        package['recipients'] = {
+            slot: (entry['key_backend'], binascii.a2b_base64(entry['encrypted_key']))
+            for slot, entry in encoded['recipients'].items()
+        }
+        for field in ENVELOPE_MULTI_FIELDS:
+            package[field] = binascii.a2b_base64(encoded[field])
+        return package
+
+    if package['mode'] == 'ratchet':
+        package['session_id'] = encoded['session_id']
+        package['counter'] = encoded['counter']
+    else:
+        package['key_id'] = encoded.get('key_id')
+    # a2b_base64 reads the ASCII str directly, skipping b64decode's encode() copy
+    for field in ENVELOPE_BINARY_FIELDS:
+        package[field] = binascii.a2b_base64(encoded[field])
+    return package
+
+
+# Streaming attachments: header, then length-prefixed AES-GCM chunks
+ATTACHMENT_MAGIC = b'EA'
+ATTACHMENT_VERSION = 1
+ATTACHMENT_HEADER = struct.Struct('>2sBBIHH')
+ATTACHMENT_CHUNK_LENGTH = struct.Struct('>I')
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _attachment_keys(file_key, attachment_id):
+    """Derive the chunk key and 7-byte nonce prefix from a file key"""
+    material = HKDF(
+        algorithm=hashes.SHA256(),
+        length=39,
+        salt=None,
+        info=b"enclave-attachment:" + attachment_id.encode()
+    ).derive(file_key)
+    return AESGCM(material[:32]), material[32:]
+
+
+def _chunk_nonce(nonce_prefix, index, final):
+    """Nonce for chunk ``index``; the last byte marks the final chunk"""
+    return nonce_prefix + struct.pack('>IB', index, 1 if final else 0)
+
+
+def envelope_to_transport(envelope):
+    """Fields carrying an envelope inside a JSON ``encrypted_message`` frame
+
+    JSON envelopes travel as ``content`` for older peers; binary envelopes
+    are base64-encoded once as ``envelope``.
+    """
+    if isinstance(envelope, (bytes, bytearray)):
+        return {'envelope': base64.b64encode(envelope).decode()}
+    return {'content': envelope}
+
+
+def envelope_from_transport(message_data):
+    """Extract the envelope from a received ``encrypted_message`` frame"""
+    if 'envelope' in message_data:
+        return base64.b64decode(message_data['envelope'])
+    return message_data['content']
+
+
+def unwrap_key(private_key, wrapped_key, backend_name='rsa'):
+    """Recover a symmetric key wrapped for ``private_key``"""
+    backend = key_backend_for(private_key)
+    if backend_name != backend.name:
+        raise ValueError(f"Key was wrapped for a {backend_name} key, ours is {backend.name}")
+    return backend.unwrap(private_key, wrapped_key)
+
+
+def compress_payload(data, algorithm):
+    """Compress a plaintext with ``algorithm`` ('zlib' or 'zstd')"""
+    if algorithm == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if algorithm == 'zlib':
+        return zlib.compress(data, 6)
+    raise ValueError(f"Unsupported compression: {algorithm}")
+
+
+def decompress_payload(data, algorithm, max_size=COMPRESSION_MAX_SIZE):
+    """Inflate a decrypted payload, refusing output larger than ``max_size``"""
+    if algorithm == 'zlib':
+        inflater = zlib.decompressobj()
+        output = inflater.decompress(data, max_size + 1)
+        if len(output) > max_size or inflater.unconsumed_tail:
+            raise ValueError("Decompressed message exceeds size limit")
+        if not inflater.eof:
+            raise ValueError("Truncated compressed message")
+        return output
+    if algorithm == 'zstd' and zstandard:
+        # Streamed read, so a forged frame content size cannot force the allocation
+        with zstandard.ZstdDecompressor().stream_reader(bytes(data)) as reader:
+            output = reader.read(max_size + 1)
+        if len(output) > max_size:
+            raise ValueError("Decompressed message exceeds size limit")
+        return output
+    raise ValueError(f"Unsupported compression: {algorithm}")
+
+
+def encryption_method(mode, key_backend):
+    """Label stored with a message: the envelope mode, plus the key backend unless RSA"""
+    return mode if key_backend == 'rsa' else f"{mode}-{key_backend}"
+
+
+def _decrypted_result(plaintext_bytes, metadata, method='hybrid', metrics=NULL_METRICS):
+    compression = metadata.get('compression')
+    if compression:
+        with metrics.time('decompress'):
+            plaintext_bytes = decompress_payload(plaintext_bytes, compression)
+    return {
+        'message': plaintext_bytes.decode(),
+        'sender': metadata['sender'],
+        'timestamp': metadata['timestamp'],
+        'message_id': metadata['message_id'],
+        'sequence': metadata.get('sequence'),
+        'encryption_method': method
+    }
+
+
+def _wrapped_key_for(private_key, package, metadata, fingerprint=None):
+    """The ``(key backend, wrapped key)`` of a stateless package meant for ``private_key``"""
+    if package['mode'] == 'multi':
+        if fingerprint is None:
+            fingerprint = key_fingerprint(private_key.public_key())
+        slot = package['recipients'].get(fingerprint)
+        if slot is None:
+            raise ValueError("Message is not addressed to this key")
+        if fingerprint not in metadata.get('recipients', ()):
+            raise ValueError("Recipient table does not match metadata")
+        return slot
+    if package['mode'] == 'hybrid':
+        return package['key_backend'], package['encrypted_key']
+    raise ValueError(f"Cannot open {package['mode']} package without session state")
+
+
+class DecryptedMessage:
+    """Result of decrypt_bytes(), decompressing and decoding only on demand
+
+    ``plaintext`` is the message as bytes and ``message`` as text; both are
+    computed on first access. Supports ``result['message']`` style access
+    like the dicts returned by decrypt_message().
+    """
+
+    __slots__ = ('sender', 'timestamp', 'message_id', 'sequence', 'encryption_method', 'compression',
+                 '_payload', '_plaintext', '_message', '_metrics')
+
+    FIELDS = ('message', 'sender', 'timestamp', 'message_id', 'sequence', 'encryption_method')
+
+    def __init__(self, payload, metadata, method='hybrid', metrics=NULL_METRICS):
+        self.sender = metadata['sender']
+        self.timestamp = metadata['timestamp']
+        self.message_id = metadata['message_id']
+        self.sequence = metadata.get('sequence')
+        self.encryption_method = method
+        self.compression = metadata.get('compression')
+        self._payload = payload
+        self._plaintext = None
+        self._message = None
+        self._metrics = metrics
+
+    @property
+    def plaintext(self):
+        if self._plaintext is None:
+            if self.compression:
+                with self._metrics.time('decompress'):
+                    self._plaintext = decompress_payload(self._payload, self.compression)
+            else:
+                self._plaintext = self._payload
+            self._payload = None
+        return self._plaintext
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = self.plaintext.decode()
+        return self._message
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def open_package(private_key, package, fingerprint=None, metrics=NULL_METRICS):
+    """Decrypt a stateless (hybrid or multi-recipient) package
+
+    Needs only the private key, so it can run in worker processes.
+    """
+    metadata_bytes = package['metadata']
+    metadata = json.loads(bytes(metadata_bytes))
+    key_backend, wrapped_key = _wrapped_key_for(private_key, package, metadata, fingerprint)
+
+    # Decrypt session key, then the message with its metadata as AAD
+    with metrics.time('key_unwrap'):
+        session_key = unwrap_key(private_key, wrapped_key, key_backend)
+    with metrics.time('aead_decrypt'):
+        plaintext_bytes = AESGCM(session_key).decrypt(
+            package['nonce'], package['ciphertext'], metadata_bytes
+        )
+    return _decrypted_result(plaintext_bytes, metadata, encryption_method(package['mode'], key_backend), metrics)
+
+
+# Private key loaded once per decrypt_many worker process
+_worker_private_key = None
+
+
+def _init_decrypt_worker(private_pem):
+    global _worker_private_key
+    _worker_private_key = serialization.load_pem_private_key(private_pem, password=None)
+
+
+def _decrypt_in_worker(envelope):
+    try:
+        return open_package(_worker_private_key, decode_envelope(envelope))
+    except Exception as e:
+        return {'error': f"Failed to decrypt message: {str(e)}"}
+
+
+def message_digest(message_id):
+    """128-bit hash of a message id; range digests are sums of these"""
+    return int.from_bytes(hashlib.sha256(message_id.encode()).digest()[:16], 'big')
+
+
+def split_range(first, end, parts=DIGEST_FANOUT):
+    """Split a bucket range into at most ``parts`` contiguous sub-ranges"""
+    width = -(-(end - first) // parts)
+    return [(start, min(start + width, end)) for start in range(first, end, width)]
+
+
+def conversation_key(user_a, user_b):
+    """Order-independent key identifying the conversation between two users"""
+    first, second = sorted((user_a, user_b))
+    return f"{first}{CONVERSATION_SEPARATOR}{second}"
+
+
+class ConnectionManager:
+    """Thread-local SQLite connections tuned for concurrent messaging workloads
+
+    Each thread gets its own long-lived connection in WAL mode, so readers
+    never block the writer and no call pays for a fresh connect. Statements
+    are compiled once per connection and reused from sqlite3's statement cache.
+    """
+
+    def __init__(self, db_path, cache_size_kb=16384, busy_timeout=30.0,
+                 cached_statements=256):
+        self.db_path = db_path
+        self.cache_size_kb = cache_size_kb
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  # thread ident -> (thread, connection)
+        self._closed = False
+
+    def _open(self):
+        """Open and configure a connection for the calling thread"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False
+        )
+        # Must precede the first write to a new database to take effect
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL makes NORMAL safe against corruption; only the last commits
+        # before a power loss can roll back
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _reap_dead_threads(self):
+        """Close connections left behind by threads that have exited"""
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                del self._connections[ident]
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection manager is closed")
+            self._reap_dead_threads()
+            conn = self._open()
+            thread = threading.current_thread()
+            self._connections[thread.ident] = (thread, conn)
+
+        self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run a block in a single transaction, committing on success"""
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def close(self):
+        """Close every connection opened by this manager"""
+        with self._lock:
+            self._closed = True
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for _, conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional TTL and usage counters"""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Size and hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        # One 32-bit word of a single BLAKE2b digest per hash (at most 16)
+        self.hashes = min(16, max(1, round(self.size / capacity * math.log(2))))
+        self._words = struct.Struct(f'>{self.hashes}I')
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        """Bit positions of ``item``; equal for filters of the same capacity and error rate"""
+        digest = hashlib.blake2b(item.encode(), digest_size=4 * self.hashes).digest()
+        return [word % self.size for word in self._words.unpack(digest)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def has_positions(self, positions):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def __contains__(self, item):
+        return self.has_positions(self.positions(item))
+
+
+class ReplayGuard:
+    """Time-windowed set of recently seen message ids
+
+    Ids go into Bloom filter generations of ``capacity`` ids each. A new
+    generation starts whenever the current one is full, and a generation
+    is dropped once its newest id is older than ``window`` seconds, so an
+    id stays in memory for at least one full window. Memory follows the
+    number of ids seen within the window (about 1.8 bytes each at the
+    default error rate) instead of a fixed filter saturating under load.
+    A miss means the id is certainly new; a hit only means it may have
+    been seen and must be confirmed against the authoritative
+    seen_messages table.
+    """
+
+    def __init__(self, window=REPLAY_WINDOW, capacity=REPLAY_CAPACITY, error_rate=0.001):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+
+        self._generations = deque()   # [filter, newest add time], oldest first
+
+    def _expire(self, now):
+        generations = self._generations
+        while generations and generations[0][1] < now - self.window:
+            generations.popleft()
+
+    def might_contain(self, message_id):
+        self._expire(time.time())
+        if not self._generations:
+            return False
+        # All generations share one size, so the id is hashed only once
+        positions = self._generations[0][0].positions(message_id)
+        return any(bloom.has_positions(positions) for bloom, _ in reversed(self._generations))
+
+    def add(self, message_id, seen_at=None):
+        now = time.time() if seen_at is None else seen_at
+        self._expire(now)
+        generations = self._generations
+        if not generations or generations[-1][0].count >= self.capacity:
+            generations.append([BloomFilter(self.capacity, self.error_rate), now])
+        generation = generations[-1]
+        generation[0].add(message_id)
+        generation[1] = max(generation[1], now)
+
+    def stats(self):
+        return {
+            'window': self.window,
+            'generations': len(self._generations),
+            'ids': sum(bloom.count for bloom, _ in self._generations),
+            'bytes': sum(len(bloom.bits) for bloom, _ in self._generations)
+        }
+
+
+class ChainRatchet:
+    """Symmetric hash-chain ratchet yielding one key per message
+
+    Each step derives ``message_key = HMAC(chain_key, 0x01)`` and replaces
+    the chain key with ``HMAC(chain_key, 0x02)``. Old chain keys are
+    discarded, so the current state cannot recover earlier message keys.
+    """
+
+    def __init__(self, root_secret, session_id, contact):
+        self.session_id = session_id
+        self.contact = contact
+        self.chain_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b"enclave-ratchet:" + session_id.encode()
+        ).derive(root_secret)
+        self.counter = 0
+        self.skipped = OrderedDict()  # counter -> message key
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _step(chain_key):
+        return (hmac.digest(chain_key, b"\x01", "sha256"),
+                hmac.digest(chain_key, b"\x02", "sha256"))
+
+    def next_key(self):
+        """Advance one step and return (counter, message_key)"""
+        message_key, self.chain_key = self._step(self.chain_key)
+        counter = self.counter
+        self.counter += 1
+        return counter, message_key
+
+    def peek_key(self, counter):
+        """Derive the key for ``counter`` without changing state
+
+        Returns ``(message_key, pending)``; pass ``pending`` to commit() once
+        the message has authenticated, so forged counters cannot move the chain.
+        """
+        if counter < self.counter:
+            message_key = self.skipped.get(counter)
+            if message_key is None:
+                raise ValueError("Message key already used or expired")
+            return message_key, None
+
+        if counter >= RATCHET_MAX_CHAIN:
+            raise ValueError("Ratchet counter out of range")
+        # Unauthenticated counters may only cost as much work as the skip window
+        if counter - self.counter > RATCHET_MAX_SKIP:
+            raise ValueError("Ratchet counter too far ahead")
+
+        chain_key = self.chain_key
+        skipped = []
+        for skipped_counter in range(self.counter, counter):
+            message_key, chain_key = self._step(chain_key)
+            # Only the most recent gap keys are worth remembering
+            if counter - skipped_counter <= RATCHET_MAX_SKIP:
+                skipped.append((skipped_counter, message_key))
+        message_key, chain_key = self._step(chain_key)
+        return message_key, (counter + 1, chain_key, skipped)
+
+    def commit(self, counter, pending):
+        """Apply the state change from a successful peek_key()"""
+        if pending is None:
+            self.skipped.pop(counter, None)
+            return
+
+        self.counter, self.chain_key, skipped = pending
+        self.skipped.update(skipped)
+        while len(self.skipped) > RATCHET_MAX_SKIP:
+            self.skipped.popitem(last=False)
+
+
+class WriteBehindQueue:
+    """Background writer that group-commits queued rows
+
+    Rows are collected until ``batch_size`` is reached or ``flush_interval``
+    seconds have passed since the first row of the batch, then handed to
+    ``write_batch`` as a single call, so one transaction and one sync cover
+    the whole batch. ``flush()`` is a durability barrier: it returns once
+    everything submitted before it has been written.
+    """
+
+    _STOP = object()
+
+    def __init__(self, write_batch, batch_size=256, flush_interval=0.05, max_pending=10000):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()   # keeps flush barriers ahead of the stop marker
+        self._thread = threading.Thread(target=self._run, name="enclave-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        """Queue a row for writing, blocking while the queue is full"""
+        if self._closed:
+            raise RuntimeError("Write-behind queue is closed")
+        self._queue.put(row)
+
+    def flush(self, timeout=None):
+        """Block until every row submitted so far has been committed
+
+        Raises RuntimeError once the queue is closed; close() has already
+        written everything and no writer is left to answer.
+        """
+        barrier = threading.Event()
+        with self._lock:
+            if self._closed or not self._thread.is_alive():
+                raise RuntimeError("Write-behind queue is closed")
+            self._queue.put(barrier)
+        if not barrier.wait(timeout):
+            raise TimeoutError("Timed out waiting for queued messages to be written")
+        self._raise_pending_error()
+
+    def close(self, timeout=None):
+        """Write everything still queued and stop the writer thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._raise_pending_error()
+
+    def _raise_pending_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _collect(self, item):
+        """Gather one batch starting with ``item``"""
+        batch, barriers, stop = [], [], False
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            if item is self._STOP:
+                stop = True
+                break
+            if isinstance(item, threading.Event):
+                barriers.append(item)
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+        return batch, barriers, stop
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, barriers, stop = self._collect(self._queue.get())
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    # Surface the failure to the next flush()/close() caller
+                    self._error = e
+            for barrier in barriers:
+                barrier.set()
 
 
 class SecureMessenger:
     """Advanced secure messaging with hybrid encryption and forward secrecy"""
 
-    def __init__(self, username, data_dir="./enclave_data"):
+    def __init__(self, username, data_dir="./enclave_data", write_behind=False,
+                 batch_size=256, flush_interval=0.05, session_mode=False,
+                 session_rotate_after=1000, key_backend='rsa', binary_envelopes=False,
+                 session_key_cache_size=1024, session_key_ttl=3600, maintenance_interval=None,
+                 contact_cache_size=1024, contact_cache_ttl=300,
+                 compression=True, compression_threshold=COMPRESSION_THRESHOLD,
+                 metrics=None, storage='sqlite', log_segment_size=64 * 1024 * 1024,
+                 log_retention=None, replay_window=REPLAY_WINDOW, replay_capacity=REPLAY_CAPACITY,
+                 archive_after=None, key_pool=None):
         self.username = username
         self.data_dir = data_dir
+
+        # Per-stage timings: pass True for a private registry or a shared
+        # MetricsRegistry; disabled by default
+        if metrics is True:
+            metrics = MetricsRegistry()
+        self.metrics = metrics or NULL_METRICS
+
         self.db_path = os.path.join(data_dir, "enclave.db")
         os.makedirs(data_dir, exist_ok=True)
 
+        # Shared, thread-safe database access
+        self.db = ConnectionManager(self.db_path)
+
         # Initialize encryption components
+        if key_backend not in KEY_BACKENDS:
+            raise ValueError(f"Unknown key backend: {key_backend}")
+        self.key_backend = KEY_BACKENDS[key_backend]
         self.symmetric_key = None
         self.private_key = None
         self.public_key = None
-        self.session_keys = {}
+        # Optional KeyPool handing out pre-generated key pairs for new users
+        self.key_pool = key_pool
+        # AES-GCM contexts of received keys, keyed by a digest of the wrapped key
+        self.aead_cache = LRUCache(session_key_cache_size, ttl=session_key_ttl)
+        self.session_key_ttl = session_key_ttl
         self.message_counter = 0
 
+        # Parsed contact keys; the TTL bounds staleness if another process
+        # sharing the database replaces a key
+        self.contact_cache = LRUCache(contact_cache_size, ttl=contact_cache_ttl)
+
+        # Ratchet sessions: one asymmetric wrap per session, symmetric per message
+        self.session_mode = session_mode
+        self.session_rotate_after = session_rotate_after
+        self._send_sessions = {}              # contact -> (ChainRatchet, wrapped root, backend)
+        self._recv_sessions = OrderedDict()   # (session_id, wrapped root digest) -> ChainRatchet
+        self._ratchet_lock = threading.Lock()
+
+        # Send compact binary envelopes to peers that accept them
+        self.binary_envelopes = binary_envelopes
+
+        # Compress large plaintexts before encryption
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
         # Initialize database
         self._init_database()
 
+        # Messages live in SQLite or, for high-ingest relays, in an
+        # append-only segment log (contacts, keys and stats stay in SQLite)
+        if storage not in ('sqlite', 'log'):
+            raise ValueError(f"Unknown storage backend: {storage}")
+        self.message_log = None
+        self.log_retention = log_retention
+        if storage == 'log':
+            self.message_log = MessageLog(os.path.join(data_dir, "message_log"),
+                                          segment_size=log_segment_size)
+            # Full-text search indexes the SQLite table only
+            self.search_enabled = False
+        self._bookkeeping = []
+        self._bookkeeping_floors = {}
+        self._bookkeeping_since = 0.0
+        self._bookkeeping_lock = threading.RLock()
+        if self.message_log:
+            self._recover_bookkeeping()
+
+        # Last sequence number given to our messages, per conversation
+        self._sequences = {}
+        self._sequence_lock = threading.Lock()
+
+        # Messages older than archive_after seconds move to monthly archive
+        # files during maintenance; reads span both tiers
+        self.archive_after = archive_after
+        self.archive = MessageArchive(os.path.join(data_dir, "archive"))
+        # Partition lists per conversation, so hot-only reads skip the catalog
+        self.archive_catalog = LRUCache(contact_cache_size, ttl=contact_cache_ttl)
+
+        # Remembers recent incoming message ids so replays are not stored twice
+        self.replay_guard = ReplayGuard(replay_window, replay_capacity)
+        self._load_replay_guard()
+
         # Load or generate keys
         self._load_or_generate_keys()
 
+        # Optional group-commit writer for store_message
+        self.writer = None
+        if write_behind:
+            self.writer = WriteBehindQueue(self._write_message_rows, batch_size, flush_interval)
+
+        # Optional periodic retention and vacuuming
+        self._maintenance_stop = threading.Event()
+        self._maintenance_thread = None
+        if maintenance_interval:
+            self._maintenance_thread = threading.Thread(
+                target=self._maintenance_loop, args=(maintenance_interval,),
+                name="enclave-maintenance", daemon=True
+            )
+            self._maintenance_thread.start()
+
     def _init_database(self):
         """Initialize SQLite database for message storage"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.db.transaction() as conn:
+            # Take the write lock up front so concurrent processes migrate once
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            self._create_tables(cursor)
+            self._migrate_schema(cursor)
+
+            # FTS5 is optional in SQLite builds; search is disabled without it
+            self.search_enabled = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone() is not None
+
+    def _create_tables(self, cursor):
+        """Create the base schema"""
 
         # Messages table
         cursor.execute("""
@@ -80,8 +1153,41 @@ class SecureMessenger:
             )
         """)
 
-        conn.commit()
-        conn.close()
+    def _migrate_schema(self, cursor):
+        """Upgrade an existing database to the current schema version"""
+        migrations = [
+            self._migrate_conversation_index,
+            self._migrate_contact_capabilities,
+            self._migrate_session_key_retention,
+            self._migrate_search_index,
+            self._migrate_message_stats,
+            self._migrate_replay_index,
+            self._migrate_conversation_digests,
+            self._migrate_sync_state,
+            self._migrate_archive_catalog,
+            self._migrate_log_checkpoint,
+            self._migrate_seen_owner,
+            self._migrate_sync_owner,
+        ]
+
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, migrate in enumerate(migrations[version:], start=version + 1):
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+
+    def _migrate_conversation_index(self, cursor):
+        """v1: normalized conversation key with an index for history paging"""
+        cursor.execute("ALTER TABLE messages ADD COLUMN conversation TEXT")
+        cursor.execute("""
+            UPDATE messages SET conversation = CASE
+                WHEN sender < recipient THEN sender || char(31) || recipient
+                ELSE recipient || char(31) || sender
+            END
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (conversation, timestamp)
+        """)
 
     def _load_or_generate_keys(self):
         """Load existing keys or generate new ones"""
@@ -104,18 +1210,24 @@ class SecureMessenger:
             # Load symmetric key
             self.symmetric_key = base64.b64decode(key_data['symmetric_key'])
 
+            # Existing keys decide the backend, whatever was requested
+            self.key_backend = key_backend_for(self.private_key)
+
         else:
             # Generate new keys
             self._generate_keys()
             self._save_keys(key_file)
 
+        self.key_fingerprint = key_fingerprint(self.public_key)
+
     def _generate_keys(self):
-        """Generate RSA key pair and symmetric key"""
-        # Generate RSA key pair for asymmetric encryption
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048
-        )
+        """Generate asymmetric key pair and symmetric key"""
+        # Generate key pair for the configured key-agreement backend,
+        # taking a ready one from the key pool when it has the same backend
+        if self.key_pool is not None and self.key_pool.key_backend == self.key_backend.name:
+            self.private_key = self.key_pool.take()
+        else:
+            self.private_key = self.key_backend.generate_private_key()
         self.public_key = self.private_key.public_key()
 
         # Generate symmetric key for fast encryption
@@ -140,183 +1252,1748 @@ class SecureMessenger:
             'private_key': private_pem.decode(),
             'public_key': public_pem.decode(),
             'symmetric_key': base64.b64encode(self.symmetric_key).decode(),
+            'key_backend': self.key_backend.name,
             'created_at': time.time()
         }
 
         with open(key_file, 'w') as f:
             json.dump(key_data, f, indent=2)
 
-    def get_public_key_pem(self):
-        """Get public key in PEM format for sharing"""
-        return self.public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode()
-
-    def add_contact(self, username, public_key_pem, trust_level=0):
-        """Add a contact with their public key"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _migrate_contact_capabilities(self, cursor):
+        """v2: remember the features each contact advertised in key exchange"""
+        cursor.execute("ALTER TABLE contacts ADD COLUMN capabilities TEXT")
 
+    def _migrate_session_key_retention(self, cursor):
+        """v3: index session keys by age for batched retention"""
         cursor.execute("""
-            INSERT OR REPLACE INTO contacts (username, public_key, last_seen, trust_level)
-            VALUES (?, ?, ?, ?)
-        """, (username, public_key_pem, time.time(), trust_level))
+            CREATE INDEX IF NOT EXISTS idx_session_keys_created
+            ON session_keys (created_at)
+        """)
 
-        conn.commit()
-        conn.close()
+    def _migrate_search_index(self, cursor):
+        """v4: FTS5 index over message content, kept current by triggers"""
+        try:
+            cursor.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content, content='messages', content_rowid='id'
+                )
+            """)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5
+            return
 
-    def get_contact_public_key(self, username):
-        """Get a contact's public key"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
 
-        cursor.execute('SELECT public_key FROM contacts WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        conn.close()
+    def _migrate_message_stats(self, cursor):
+        """v5: materialized sent/received counters, backfilled in one pass"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_stats (
+                owner TEXT NOT NULL,
+                contact TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                received INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (owner, contact, day)
+            ) WITHOUT ROWID
+        """)
+        # Every message counts once for its sender and once for its recipient,
+        # rolled up per contact-day, per contact, per day and overall
+        cursor.execute("""
+            INSERT OR REPLACE INTO message_stats (owner, contact, day, sent, received)
+            WITH events (owner, contact, day, sent, received) AS (
+                SELECT sender, recipient, date(timestamp, 'unixepoch'), 1, 0 FROM messages
+                UNION ALL
+                SELECT recipient, sender, date(timestamp, 'unixepoch'), 0, 1 FROM messages
+            )
+            SELECT owner, contact, day, SUM(sent), SUM(received)
+            FROM events GROUP BY owner, contact, day
+            UNION ALL
+            SELECT owner, contact, ?, SUM(sent), SUM(received)
+            FROM events GROUP BY owner, contact
+            UNION ALL
+            SELECT owner, ?, day, SUM(sent), SUM(received)
+            FROM events GROUP BY owner, day
+            UNION ALL
+            SELECT owner, ?, ?, SUM(sent), SUM(received)
+            FROM events GROUP BY owner
+        """, (STATS_ALL,) * 4)
 
-        if result:
-            public_key_pem = result[0]
-            return serialization.load_pem_public_key(public_key_pem.encode())
-        return None
+    def _migrate_replay_index(self, cursor):
+        """v6: keep message ids, plus a windowed index of ids already received"""
+        cursor.execute("ALTER TABLE messages ADD COLUMN message_id TEXT")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                message_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_seen_messages_seen_at
+            ON seen_messages (seen_at)
+        """)
 
-    def generate_session_key(self, contact):
-        """Generate a new session key for forward secrecy"""
-        session_key = AESGCM.generate_key(bit_length=256)
-        key_id = secrets.token_hex(16)
+    def _migrate_conversation_digests(self, cursor):
+        """v7: per-hour digests of message ids for history reconciliation
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Stored messages are folded in by v12, once digests have an owner.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_digests (
+                conversation TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                digest BLOB NOT NULL,
+                PRIMARY KEY (conversation, bucket)
+            ) WITHOUT ROWID
+        """)
 
+    def _migrate_sync_state(self, cursor):
+        """v8: per-conversation sequence numbers and high-water marks for delta sync"""
+        cursor.execute("ALTER TABLE messages ADD COLUMN sequence INTEGER")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_sequence
+            ON messages (conversation, sender, sequence) WHERE sequence IS NOT NULL
+        """)
+        # Highest sequence up to which every message of a sender is stored
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                conversation TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                high_water INTEGER NOT NULL,
+                PRIMARY KEY (conversation, sender)
+            ) WITHOUT ROWID
+        """)
+        # Sequences stored above a gap, folded in once the gap is filled
         cursor.execute("""
-            INSERT INTO session_keys (contact, key_id, key_data, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (contact, key_id, base64.b64encode(session_key).decode(), time.time()))
+            CREATE TABLE IF NOT EXISTS sync_pending (
+                conversation TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                sequence INTEGER NOT NULL,
+                PRIMARY KEY (conversation, sender, sequence)
+            ) WITHOUT ROWID
+        """)
 
-        conn.commit()
-        conn.close()
+    def _migrate_archive_catalog(self, cursor):
+        """v9: catalog of archive partitions per conversation, and an age index to archive by"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive_partitions (
+                conversation TEXT NOT NULL,
+                partition TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                first_timestamp REAL NOT NULL,
+                last_timestamp REAL NOT NULL,
+                PRIMARY KEY (conversation, partition)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)")
 
-        self.session_keys[f"{contact}_{key_id}"] = session_key
+    def _migrate_log_checkpoint(self, cursor):
+        """v10: id of the last log message whose bookkeeping is in SQLite"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS log_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                last_id INTEGER NOT NULL
+            )
+        """)
+
+    def _migrate_seen_owner(self, cursor):
+        """v11: scope received message ids to the user who received them
+
+        Several users may share one database; existing ids are assigned to
+        the recipient of the stored message they belong to.
+        """
+        cursor.execute("""
+            CREATE TABLE seen_messages_owned (
+                owner TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                seen_at REAL NOT NULL,
+                PRIMARY KEY (owner, message_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            INSERT OR IGNORE INTO seen_messages_owned (owner, message_id, seen_at)
+            SELECT messages.recipient, seen_messages.message_id, seen_messages.seen_at
+            FROM messages JOIN seen_messages ON seen_messages.message_id = messages.message_id
+        """)
+        cursor.execute("DROP TABLE seen_messages")
+        cursor.execute("ALTER TABLE seen_messages_owned RENAME TO seen_messages")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_seen_messages_seen_at
+            ON seen_messages (seen_at)
+        """)
+
+    def _migrate_sync_owner(self, cursor):
+        """v12: key digests and sync state by the user whose view they describe
+
+        Several users may share one database. Existing rows are copied to
+        both participants of their conversation; digests that were never
+        filled (databases from before v7) are folded from stored messages.
+        """
+        cursor.execute("""
+            CREATE TABLE conversation_digests_owned (
+                owner TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                digest BLOB NOT NULL,
+                PRIMARY KEY (owner, conversation, bucket)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE sync_state_owned (
+                owner TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                high_water INTEGER NOT NULL,
+                PRIMARY KEY (owner, conversation, sender)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE sync_pending_owned (
+                owner TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                sequence INTEGER NOT NULL,
+                PRIMARY KEY (owner, conversation, sender, sequence)
+            ) WITHOUT ROWID
+        """)
+
+        participants = ("substr(conversation, 1, instr(conversation, char(31)) - 1)",
+                        "substr(conversation, instr(conversation, char(31)) + 1)")
+        filled = cursor.execute("SELECT 1 FROM conversation_digests LIMIT 1").fetchone()
+        for table, columns in (('conversation_digests', 'conversation, bucket, count, digest'),
+                               ('sync_state', 'conversation, sender, high_water'),
+                               ('sync_pending', 'conversation, sender, sequence')):
+            for owner in participants:
+                cursor.execute(f"""
+                    INSERT OR IGNORE INTO {table}_owned (owner, {columns})
+                    SELECT {owner}, {columns} FROM {table}
+                """)
+            cursor.execute(f"DROP TABLE {table}")
+            cursor.execute(f"ALTER TABLE {table}_owned RENAME TO {table}")
+
+        if not filled:
+            for owner in participants:
+                self._fold_digests(cursor.connection, cursor.connection.execute(f"""
+                    SELECT DISTINCT {owner}, conversation, timestamp, message_id
+                    FROM messages WHERE message_id IS NOT NULL
+                """))
+
+    def _load_replay_guard(self):
+        """Refill the Bloom filter from ids seen within the replay window"""
+        cutoff = time.time() - self.replay_guard.window
+        rows = self.db.connection().execute("""
+            SELECT message_id, seen_at FROM seen_messages
+            WHERE owner = ? AND seen_at >= ? ORDER BY seen_at
+        """, (self.username, cutoff))
+        for message_id, seen_at in rows:
+            self.replay_guard.add(message_id, seen_at)
+
+    def get_public_key_pem(self):
+        """Get public key in PEM format for sharing"""
+        return self.public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+
+    @property
+    def capabilities(self):
+        """Features this messenger can receive, advertised during key exchange"""
+        return ['ratchet', 'binary', 'multi', 'sync'] + list(KEY_BACKENDS) + COMPRESSION_ALGORITHMS
+
+    def get_key_exchange_payload(self):
+        """Build the key-exchange message announcing our key and capabilities"""
+        return {
+            'type': 'key_exchange',
+            'username': self.username,
+            'public_key': self.get_public_key_pem(),
+            'key_backend': self.key_backend.name,
+            'capabilities': self.capabilities
+        }
+
+    def accept_key_exchange(self, payload):
+        """Add the sender of a key-exchange message as a contact
+
+        Peers that predate capability negotiation send no list and are
+        treated as supporting only the original hybrid scheme. Returns
+        ``(username, changed)``, where ``changed`` is False when the
+        payload repeated what we already had.
+        """
+        username = payload['username']
+        changed = self.add_contact(username, payload['public_key'],
+                                   capabilities=payload.get('capabilities', []))
+        return username, changed
+
+    def add_contact(self, username, public_key_pem, trust_level=0, capabilities=None):
+        """Add a contact with their public key
+
+        ``capabilities`` lists what the contact advertised; None means
+        unknown, in which case our own settings decide. Returns False
+        without writing anything when the contact is stored unchanged.
+        """
+        if capabilities is not None:
+            capabilities = json.dumps(sorted(capabilities))
+
+        stored = self.db.connection().execute(
+            "SELECT public_key, trust_level, capabilities FROM contacts WHERE username = ?", (username,)
+        ).fetchone()
+        if stored == (public_key_pem, trust_level, capabilities):
+            return False
+
+        with self.db.transaction() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO contacts (username, public_key, last_seen,
+                                                 trust_level, capabilities)
+                VALUES (?, ?, ?, ?, ?)
+            """, (username, public_key_pem, time.time(), trust_level, capabilities))
+
+        self.contact_cache.pop(username)
+        if stored is None or stored[0] != public_key_pem:
+            # A replaced key invalidates the session wrapped for the old one
+            with self._ratchet_lock:
+                self._send_sessions.pop(username, None)
+        return True
+
+    def _get_contact(self, username):
+        """Return a contact's parsed public key, fingerprint and capabilities
+
+        Served from the contact cache when possible, so repeated sends to
+        the same contact skip both the query and the PEM parse.
+        """
+        contact = self.contact_cache.get(username)
+        if contact is None:
+            contact = self._load_contact(username)
+            if contact is not None:
+                self.contact_cache[username] = contact
+        return contact
+
+    def _load_contact(self, username):
+        """Load and parse a contact record from the database"""
+        with self.metrics.time('db_contact_load'):
+            result = self.db.connection().execute(
+                'SELECT public_key, capabilities FROM contacts WHERE username = ?', (username,)
+            ).fetchone()
+
+        if not result:
+            return None
+
+        public_key_pem, capabilities = result
+        public_key = serialization.load_pem_public_key(public_key_pem.encode())
+        return {
+            'public_key': public_key,
+            'fingerprint': key_fingerprint(public_key),
+            'capabilities': set(json.loads(capabilities)) if capabilities is not None else None
+        }
+
+    def get_contact_public_key(self, username):
+        """Get a contact's public key"""
+        contact = self._get_contact(username)
+        return contact['public_key'] if contact else None
+
+    def peer_supports(self, username, capability):
+        """Whether a contact can receive ``capability``"""
+        contact = self._get_contact(username)
+        if contact is None:
+            return False
+        return contact['capabilities'] is None or capability in contact['capabilities']
+
+    def generate_session_key(self, contact, used=False):
+        """Generate a new session key for forward secrecy
+
+        Keys marked ``used`` are already spent (encrypt_message wraps them
+        into the envelope at once), so they are never written to disk.
+        Other keys are kept in session_keys until purge_session_keys()
+        expires them.
+        """
+        session_key = AESGCM.generate_key(bit_length=256)
+        key_id = secrets.token_hex(16)
+        if used:
+            return key_id, session_key
+
+        with self.metrics.time('db_session_key'):
+            with self.db.transaction() as conn:
+                conn.execute("""
+                    INSERT INTO session_keys (contact, key_id, key_data, created_at, used)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (contact, key_id, base64.b64encode(session_key).decode(), time.time(), used))
         return key_id, session_key
 
-    def encrypt_message(self, recipient, message):
-        """Encrypt message with hybrid encryption"""
-        # Generate session key for this message
-        key_id, session_key = self.generate_session_key(recipient)
+    def _wrap_key(self, public_key, key):
+        """Encrypt a symmetric key for the holder of ``public_key``
+
+        Returns the wrapped key and the name of the backend used.
+        """
+        backend = key_backend_for(public_key)
+        with self.metrics.time('key_wrap'):
+            return backend.wrap(public_key, key), backend.name
+
+    def _unwrap_key(self, wrapped_key, backend_name='rsa'):
+        """Recover a symmetric key wrapped for our public key"""
+        with self.metrics.time('key_unwrap'):
+            return unwrap_key(self.private_key, wrapped_key, backend_name)
+
+    @staticmethod
+    def _can_inflate(contact, algorithm):
+        """Whether a contact can decompress ``algorithm``"""
+        if contact['capabilities'] is None:
+            # Unknown peers only get what every build can inflate
+            return algorithm == 'zlib'
+        return algorithm in contact['capabilities']
+
+    def _encode_plaintext(self, message, contacts):
+        """UTF-8 encode a message, compressing it when that pays off
+
+        Returns the bytes to encrypt and the compression used, if any.
+        Only algorithms every contact in ``contacts`` advertised are used.
+        """
+        data = message.encode()
+        if not self.compression or len(data) < self.compression_threshold:
+            return data, None
+
+        for algorithm in COMPRESSION_ALGORITHMS:
+            if all(self._can_inflate(contact, algorithm) for contact in contacts):
+                with self.metrics.time('compress'):
+                    compressed = compress_payload(data, algorithm)
+                if len(compressed) < len(data):
+                    return compressed, algorithm
+                break
+        return data, None
+
+    def _envelope_format(self, recipient, envelope_format):
+        """Pick the envelope format for a recipient"""
+        if envelope_format is not None:
+            return envelope_format
+        if self.binary_envelopes and self.peer_supports(recipient, 'binary'):
+            return 'binary'
+        return 'json'
+
+    def encrypt_message(self, recipient, message, envelope_format=None,
+                        message_id=None, timestamp=None, sequence=None):
+        """Encrypt message with hybrid encryption
+
+        Returns a JSON string, or bytes when a binary envelope is used
+        (requested explicitly or negotiated with the recipient). A fresh
+        message id and the current time are used unless given; a
+        ``sequence`` number is carried for delta sync.
+        """
+        envelope_format = self._envelope_format(recipient, envelope_format)
+        if self.session_mode and self.peer_supports(recipient, 'ratchet'):
+            package = self._encrypt_with_session(recipient, message, message_id, timestamp, sequence)
+            with self.metrics.time('serialize'):
+                return encode_envelope(package, envelope_format)
+
+        # Generate session key for this message; it is spent once encrypted
+        key_id, session_key = self.generate_session_key(recipient, used=True)
 
         # Get recipient's public key
-        recipient_public_key = self.get_contact_public_key(recipient)
-        if not recipient_public_key:
+        contact = self._get_contact(recipient)
+        if not contact:
             raise ValueError(f"No public key found for {recipient}")
+        recipient_public_key = contact['public_key']
 
         # Encrypt message with AEAD (AES-GCM)
         aesgcm = AESGCM(session_key)
         nonce = os.urandom(12)  # 96-bit nonce for GCM
 
-        # Message metadata
+        # Message metadata, encoded once and used as AAD
         metadata = {
             'sender': self.username,
-            'timestamp': time.time(),
-            'message_id': secrets.token_hex(16)
+            'timestamp': timestamp or time.time(),
+            'message_id': message_id or secrets.token_hex(16)
         }
+        if sequence is not None:
+            metadata['sequence'] = sequence
+        plaintext, compression = self._encode_plaintext(message, [contact])
+        if compression:
+            metadata['compression'] = compression
+        metadata_bytes = json.dumps(metadata).encode()
 
         # Encrypt the actual message
-        ciphertext = aesgcm.encrypt(nonce, message.encode(), json.dumps(metadata).encode())
+        with self.metrics.time('aead_encrypt'):
+            ciphertext = aesgcm.encrypt(nonce, plaintext, metadata_bytes)
 
         # Encrypt session key with recipient's public key
-        encrypted_session_key = recipient_public_key.encrypt(
-            session_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        encrypted_session_key, key_backend = self._wrap_key(recipient_public_key, session_key)
 
         # Create encrypted message package
         encrypted_package = {
+            'mode': 'hybrid',
             'key_id': key_id,
-            'encrypted_key': base64.b64encode(encrypted_session_key).decode(),
-            'nonce': base64.b64encode(nonce).decode(),
-            'ciphertext': base64.b64encode(ciphertext).decode(),
-            'metadata': base64.b64encode(json.dumps(metadata).encode()).decode()
+            'key_backend': key_backend,
+            'encrypted_key': encrypted_session_key,
+            'nonce': nonce,
+            'ciphertext': ciphertext,
+            'metadata': metadata_bytes
         }
 
-        return json.dumps(encrypted_package)
+        with self.metrics.time('serialize'):
+            return encode_envelope(encrypted_package, envelope_format)
 
-    def decrypt_message(self, encrypted_message_json):
-        """Decrypt message with hybrid encryption"""
-        try:
-            package = json.loads(encrypted_message_json)
-
-            # Decrypt session key with our private key
-            encrypted_session_key = base64.b64decode(package['encrypted_key'])
-            session_key = self.private_key.decrypt(
-                encrypted_session_key,
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None
-                )
+    def encrypt_for_recipients(self, recipients, message, envelope_format=None,
+                               message_id=None, timestamp=None):
+        """Encrypt one message for many contacts
+
+        The body is encrypted once under a fresh content key and only that
+        key is wrapped per recipient, so the cost is one body encryption
+        plus one small wrap per recipient. Each recipient finds its slot by
+        key fingerprint.
+        """
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients:
+            raise ValueError("No recipients given")
+
+        contacts = {}
+        for recipient in recipients:
+            contact = self._get_contact(recipient)
+            if not contact:
+                raise ValueError(f"No public key found for {recipient}")
+            if contact['capabilities'] is not None and 'multi' not in contact['capabilities']:
+                raise ValueError(f"{recipient} does not support multi-recipient messages")
+            contacts[recipient] = contact
+
+        if envelope_format is None:
+            binary = self.binary_envelopes and all(
+                contact['capabilities'] is None or 'binary' in contact['capabilities']
+                for contact in contacts.values()
             )
+            envelope_format = 'binary' if binary else 'json'
 
-            # Decrypt message
-            aesgcm = AESGCM(session_key)
-            nonce = base64.b64decode(package['nonce'])
-            ciphertext = base64.b64decode(package['ciphertext'])
-            metadata_bytes = base64.b64decode(package['metadata'])
+        content_key = AESGCM.generate_key(bit_length=256)
+        slots = {}
+        for contact in contacts.values():
+            wrapped_key, key_backend = self._wrap_key(contact['public_key'], content_key)
+            slots[contact['fingerprint']] = (key_backend, wrapped_key)
 
-            # Decrypt with associated data (metadata)
-            plaintext_bytes = aesgcm.decrypt(nonce, ciphertext, metadata_bytes)
+        # Slot ids sit in the authenticated metadata so the table cannot be rewritten
+        metadata = {
+            'sender': self.username,
+            'timestamp': timestamp or time.time(),
+            'message_id': message_id or secrets.token_hex(16),
+            'recipients': sorted(slots)
+        }
+        plaintext, compression = self._encode_plaintext(message, contacts.values())
+        if compression:
+            metadata['compression'] = compression
+        metadata_bytes = json.dumps(metadata).encode()
 
-            # Parse metadata
-            metadata = json.loads(metadata_bytes.decode())
+        nonce = os.urandom(12)
+        with self.metrics.time('aead_encrypt'):
+            ciphertext = AESGCM(content_key).encrypt(nonce, plaintext, metadata_bytes)
 
-            return {
-                'message': plaintext_bytes.decode(),
-                'sender': metadata['sender'],
-                'timestamp': metadata['timestamp'],
-                'message_id': metadata['message_id']
-            }
+        encrypted_package = {
+            'mode': 'multi',
+            'key_id': secrets.token_hex(16),
+            'key_backend': self.key_backend.name,
+            'recipients': slots,
+            'nonce': nonce,
+            'ciphertext': ciphertext,
+            'metadata': metadata_bytes
+        }
+
+        with self.metrics.time('serialize'):
+            return encode_envelope(encrypted_package, envelope_format)
+
+    def seal_message(self, recipient, message, envelope_format=None):
+        """Encrypt a message for ``recipient`` and store our own copy
+
+        The copy is stored under the same message id, timestamp and
+        conversation sequence number as the envelope, so both peers hold
+        identical history for digests and sync. Returns the envelope.
+        """
+        message_id, timestamp = secrets.token_hex(16), time.time()
+        sequence = self._next_sequence(recipient)
+        envelope = self.encrypt_message(recipient, message, envelope_format, message_id=message_id,
+                                        timestamp=timestamp, sequence=sequence)
+        self.store_message(self.username, recipient, message, self._encryption_method_for(recipient),
+                           message_id=message_id, timestamp=timestamp, sequence=sequence)
+        return envelope
+
+    def _encryption_method_for(self, recipient):
+        """The encryption method encrypt_message() uses for ``recipient``"""
+        mode = 'ratchet' if self.session_mode and self.peer_supports(recipient, 'ratchet') else 'hybrid'
+        return encryption_method(mode, key_backend_for(self._get_contact(recipient)['public_key']).name)
+
+    def _next_sequence(self, contact):
+        """Allocate the next sequence number for our messages to ``contact``"""
+        conversation = conversation_key(self.username, contact)
+        with self._sequence_lock:
+            if conversation not in self._sequences:
+                self.flush()
+                row = self.db.connection().execute("""
+                    SELECT high_water FROM sync_state WHERE owner = ? AND conversation = ? AND sender = ?
+                """, (self.username, conversation, self.username)).fetchone()
+                self._sequences[conversation] = row[0] if row else 0
+            self._sequences[conversation] += 1
+            return self._sequences[conversation]
+
+    def _get_send_session(self, recipient):
+        """Return the active sending ratchet for a contact, rotating when exhausted"""
+        with self._ratchet_lock:
+            entry = self._send_sessions.get(recipient)
+            if entry and entry[0].counter < self.session_rotate_after:
+                return entry
+
+            recipient_public_key = self.get_contact_public_key(recipient)
+            if not recipient_public_key:
+                raise ValueError(f"No public key found for {recipient}")
+
+            root_secret = os.urandom(32)
+            ratchet = ChainRatchet(root_secret, secrets.token_hex(16), recipient)
+            wrapped_root, key_backend = self._wrap_key(recipient_public_key, root_secret)
+            entry = (ratchet, wrapped_root, key_backend)
+            self._send_sessions[recipient] = entry
+            return entry
+
+    def _encrypt_with_session(self, recipient, message, message_id=None, timestamp=None,
+                              sequence=None):
+        """Encrypt into a ratchet package using the contact's sending chain"""
+        ratchet, wrapped_root, key_backend = self._get_send_session(recipient)
+        with ratchet.lock:
+            counter, message_key = ratchet.next_key()
+
+        metadata = {
+            'sender': self.username,
+            'timestamp': timestamp or time.time(),
+            'message_id': message_id or secrets.token_hex(16),
+            'session_id': ratchet.session_id,
+            'counter': counter
+        }
+        if sequence is not None:
+            metadata['sequence'] = sequence
+        plaintext, compression = self._encode_plaintext(message, [self._get_contact(recipient)])
+        if compression:
+            metadata['compression'] = compression
+        metadata_bytes = json.dumps(metadata).encode()
+
+        nonce = os.urandom(12)
+        with self.metrics.time('aead_encrypt'):
+            ciphertext = AESGCM(message_key).encrypt(nonce, plaintext, metadata_bytes)
+
+        # The wrapped root travels with every message so a receiver that lost
+        # its in-memory state can rejoin the session with one unwrap
+        return {
+            'mode': 'ratchet',
+            'session_id': ratchet.session_id,
+            'counter': counter,
+            'key_backend': key_backend,
+            'encrypted_key': wrapped_root,
+            'nonce': nonce,
+            'ciphertext': ciphertext,
+            'metadata': metadata_bytes
+        }
+
+    def _get_recv_session(self, session_id, wrapped_root, key_backend, sender):
+        """Find the receiving ratchet for a session, or build a candidate
+
+        Returns ``(ratchet, key, known)``. A candidate (``known`` False) is
+        not remembered until _keep_recv_session() is called after a message
+        under it authenticates. Sessions are keyed by their wrapped root
+        too, so a forged root reusing a session id can never displace the
+        genuine session.
+        """
+        key = (session_id, hashlib.blake2b(wrapped_root, digest_size=16).digest())
+        with self._ratchet_lock:
+            ratchet = self._recv_sessions.get(key)
+            if ratchet is not None:
+                self._recv_sessions.move_to_end(key)
+                return ratchet, key, True
+
+        # Only the first message of a session pays for the private-key operation
+        root_secret = self._unwrap_key(wrapped_root, key_backend)
+        return ChainRatchet(root_secret, session_id, sender), key, False
+
+    def _keep_recv_session(self, key, ratchet):
+        with self._ratchet_lock:
+            self._recv_sessions.setdefault(key, ratchet)
+            while len(self._recv_sessions) > RATCHET_MAX_SESSIONS:
+                self._recv_sessions.popitem(last=False)
+
+    def _open_session_package(self, package):
+        """Decrypt a ratchet-mode package; returns (payload, metadata)"""
+        metadata_bytes = package['metadata']
+        metadata = json.loads(bytes(metadata_bytes))
+
+        session_id = metadata['session_id']
+        counter = metadata['counter']
+        if session_id != package['session_id'] or counter != package['counter']:
+            raise ValueError("Session header does not match metadata")
+
+        ratchet, key, known = self._get_recv_session(
+            session_id, package['encrypted_key'], package['key_backend'], metadata['sender']
+        )
+        if ratchet.contact != metadata['sender']:
+            raise ValueError("Session belongs to a different sender")
+
+        with ratchet.lock:
+            message_key, pending = ratchet.peek_key(counter)
+            with self.metrics.time('aead_decrypt'):
+                plaintext_bytes = AESGCM(message_key).decrypt(
+                    package['nonce'], package['ciphertext'], metadata_bytes
+                )
+            ratchet.commit(counter, pending)
 
+        if not known:
+            self._keep_recv_session(key, ratchet)
+        return plaintext_bytes, metadata
+
+    def decrypt_message(self, encrypted_message):
+        """Decrypt message with hybrid encryption
+
+        Accepts a JSON envelope (str or bytes) or a binary envelope.
+        """
+        try:
+            return _decrypted_result(*self._open_envelope(encrypted_message), metrics=self.metrics)
         except Exception as e:
             raise ValueError(f"Failed to decrypt message: {str(e)}")
 
-    def store_message(self, sender, recipient, content, encryption_method="hybrid"):
-        """Store message in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def decrypt_bytes(self, envelope):
+        """Decrypt an envelope held in a bytes-like buffer, returning a DecryptedMessage
 
-        cursor.execute("""
-            INSERT INTO messages (sender, recipient, content, timestamp, encryption_method)
+        Binary envelopes (bytes, bytearray or memoryview) are parsed in
+        place: wrapped key, AAD and ciphertext are slices of ``envelope``
+        and are never copied before decryption. The plaintext is only
+        decompressed and decoded when read. JSON envelopes are accepted
+        too.
+        """
+        try:
+            return DecryptedMessage(*self._open_envelope(envelope), metrics=self.metrics)
+        except Exception as e:
+            raise ValueError(f"Failed to decrypt message: {str(e)}")
+
+    def _open_envelope(self, envelope):
+        """Decode and decrypt any envelope; returns (payload, metadata, encryption method)"""
+        with self.metrics.time('deserialize'):
+            package = decode_envelope(envelope)
+        if package['mode'] == 'ratchet':
+            return (*self._open_session_package(package),
+                    encryption_method('ratchet', package['key_backend']))
+
+        metadata_bytes = package['metadata']
+        metadata = json.loads(bytes(metadata_bytes))
+        key_backend, wrapped_key = _wrapped_key_for(self.private_key, package, metadata,
+                                                    self.key_fingerprint)
+        aesgcm = self._aead_for(wrapped_key, key_backend)
+        with self.metrics.time('aead_decrypt'):
+            payload = aesgcm.decrypt(package['nonce'], package['ciphertext'], metadata_bytes)
+        return payload, metadata, encryption_method(package['mode'], key_backend)
+
+    def _aead_for(self, wrapped_key, key_backend):
+        """AES-GCM context for a wrapped key, unwrapping only on a cache miss
+
+        Envelopes that share a wrapped key (retransmits, sync re-delivery,
+        relayed copies) skip the private-key operation after the first.
+        """
+        digest = hashlib.blake2b(wrapped_key, digest_size=16).digest()
+        aesgcm = self.aead_cache.get(digest)
+        if aesgcm is None:
+            aesgcm = AESGCM(self._unwrap_key(wrapped_key, key_backend))
+            self.aead_cache[digest] = aesgcm
+        return aesgcm
+
+    def _decrypt_or_error(self, envelope):
+        try:
+            return self.decrypt_message(envelope)
+        except ValueError as e:
+            return {'error': str(e)}
+
+    def decrypt_many(self, envelopes, workers=None, use_processes=False):
+        """Decrypt a backlog of envelopes in parallel
+
+        Returns one result per envelope, in input order. A failed item
+        yields ``{'error': reason}`` instead of raising, so one bad
+        envelope cannot stall the rest. With ``use_processes`` the
+        stateless envelopes are spread over spawned worker processes, so
+        callers need the usual ``if __name__ == '__main__'`` guard; ratchet
+        envelopes depend on in-memory session state and are always
+        decrypted in this process.
+        """
+        envelopes = list(envelopes)
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(envelopes) < 2:
+            return [self._decrypt_or_error(envelope) for envelope in envelopes]
+
+        if not use_processes:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(self._decrypt_or_error, envelopes))
+
+        results = [None] * len(envelopes)
+        local, remote = [], []
+        for index, envelope in enumerate(envelopes):
+            try:
+                stateless = decode_envelope(envelope)['mode'] != 'ratchet'
+            except Exception as e:
+                results[index] = {'error': f"Failed to decrypt message: {str(e)}"}
+                continue
+            (remote if stateless else local).append(index)
+
+        if remote:
+            private_pem = self.private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            # Envelopes may be memoryviews, which cannot be pickled
+            payloads = [envelope if isinstance(envelope, str) else bytes(envelope)
+                        for envelope in (envelopes[index] for index in remote)]
+            chunksize = max(1, len(payloads) // (workers * 4))
+            # Spawned workers: forking would copy our threads' locks and open SQLite handles
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_decrypt_worker,
+                                     initargs=(private_pem,),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                for index, result in zip(remote, executor.map(_decrypt_in_worker, payloads,
+                                                              chunksize=chunksize)):
+                    results[index] = result
+
+        for index in local:
+            results[index] = self._decrypt_or_error(envelopes[index])
+
+        return results
+
+    def encrypt_file(self, recipient, source_path, dest_path, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """Encrypt a file for a contact as a stream of authenticated chunks
+
+        The input is memory-mapped and each ``chunk_size`` slice is sealed
+        and written straight out, so memory use does not grow with the
+        file. Chunk nonces come from a per-file key, the final chunk is
+        flagged to detect truncation, and every chunk is bound to the
+        header. Returns the attachment metadata.
+        """
+        if not 0 < chunk_size <= ATTACHMENT_MAX_CHUNK_SIZE:
+            raise ValueError(f"Chunk size must be between 1 and {ATTACHMENT_MAX_CHUNK_SIZE}")
+
+        recipient_public_key = self.get_contact_public_key(recipient)
+        if not recipient_public_key:
+            raise ValueError(f"No public key found for {recipient}")
+
+        file_key = AESGCM.generate_key(bit_length=256)
+        wrapped_key, key_backend = self._wrap_key(recipient_public_key, file_key)
+        metadata = {
+            'sender': self.username,
+            'recipient': recipient,
+            'filename': os.path.basename(source_path),
+            'size': os.path.getsize(source_path),
+            'timestamp': time.time(),
+            'attachment_id': secrets.token_hex(16)
+        }
+        metadata_bytes = json.dumps(metadata).encode()
+
+        header = ATTACHMENT_HEADER.pack(
+            ATTACHMENT_MAGIC, ATTACHMENT_VERSION, ENVELOPE_BACKEND_IDS[key_backend],
+            chunk_size, len(wrapped_key), len(metadata_bytes)
+        ) + wrapped_key + metadata_bytes
+        header_digest = hashlib.sha256(header).digest()
+        aesgcm, nonce_prefix = _attachment_keys(file_key, metadata['attachment_id'])
+
+        with open(source_path, 'rb') as source, open(dest_path, 'wb') as dest:
+            dest.write(header)
+
+            size = metadata['size']
+            if size == 0:
+                # mmap cannot map an empty file; emit a single empty final chunk
+                chunk = aesgcm.encrypt(_chunk_nonce(nonce_prefix, 0, True), b'', header_digest)
+                dest.write(ATTACHMENT_CHUNK_LENGTH.pack(len(chunk)) + chunk)
+                return metadata
+
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for index, offset in enumerate(range(0, size, chunk_size)):
+                        final = offset + chunk_size >= size
+                        chunk = aesgcm.encrypt(
+                            _chunk_nonce(nonce_prefix, index, final),
+                            view[offset:offset + chunk_size],
+                            header_digest
+                        )
+                        dest.write(ATTACHMENT_CHUNK_LENGTH.pack(len(chunk)))
+                        dest.write(chunk)
+                finally:
+                    view.release()
+
+        return metadata
+
+    def decrypt_file(self, source_path, dest_path):
+        """Decrypt a streamed attachment, verifying each chunk as it is read
+
+        Plaintext goes to a temporary file next to ``dest_path`` and is
+        only moved into place once every chunk, the final-chunk marker and
+        the total size have checked out. Returns the attachment metadata.
+        """
+        temp_path = f"{dest_path}.part-{secrets.token_hex(4)}"
+        try:
+            with open(source_path, 'rb') as source, open(temp_path, 'wb') as dest:
+                fixed = source.read(ATTACHMENT_HEADER.size)
+                if len(fixed) < ATTACHMENT_HEADER.size:
+                    raise ValueError("Truncated attachment header")
+                magic, version, backend_id, chunk_size, wrapped_length, metadata_length = \
+                    ATTACHMENT_HEADER.unpack(fixed)
+                if magic != ATTACHMENT_MAGIC or version != ATTACHMENT_VERSION:
+                    raise ValueError("Not a supported attachment")
+                if backend_id not in ENVELOPE_BACKEND_NAMES or chunk_size > ATTACHMENT_MAX_CHUNK_SIZE:
+                    raise ValueError("Corrupt attachment header")
+
+                wrapped_key = source.read(wrapped_length)
+                metadata_bytes = source.read(metadata_length)
+                if len(wrapped_key) != wrapped_length or len(metadata_bytes) != metadata_length:
+                    raise ValueError("Truncated attachment header")
+
+                header_digest = hashlib.sha256(fixed + wrapped_key + metadata_bytes).digest()
+                metadata = json.loads(metadata_bytes)
+                file_key = self._unwrap_key(wrapped_key, ENVELOPE_BACKEND_NAMES[backend_id])
+                aesgcm, nonce_prefix = _attachment_keys(file_key, metadata['attachment_id'])
+
+                index, written, finished = 0, 0, False
+                while not finished:
+                    length_bytes = source.read(ATTACHMENT_CHUNK_LENGTH.size)
+                    if len(length_bytes) < ATTACHMENT_CHUNK_LENGTH.size:
+                        raise ValueError("Attachment is truncated")
+                    (length,) = ATTACHMENT_CHUNK_LENGTH.unpack(length_bytes)
+                    if length > chunk_size + 16:
+                        raise ValueError("Attachment chunk too large")
+                    chunk = source.read(length)
+                    if len(chunk) != length:
+                        raise ValueError("Attachment is truncated")
+
+                    # Try as a middle chunk first; only the last one carries the final flag
+                    try:
+                        plaintext = aesgcm.decrypt(_chunk_nonce(nonce_prefix, index, False),
+                                                   chunk, header_digest)
+                    except InvalidTag:
+                        plaintext = aesgcm.decrypt(_chunk_nonce(nonce_prefix, index, True),
+                                                   chunk, header_digest)
+                        finished = True
+
+                    dest.write(plaintext)
+                    written += len(plaintext)
+                    index += 1
+
+                if source.read(1):
+                    raise ValueError("Unexpected data after final chunk")
+                if written != metadata['size']:
+                    raise ValueError("Attachment size does not match metadata")
+
+            os.replace(temp_path, dest_path)
+            return metadata
+
+        except InvalidTag:
+            raise ValueError("Attachment failed authentication")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def store_message(self, sender, recipient, content, encryption_method="hybrid",
+                      message_id=None, timestamp=None, sequence=None):
+        """Store message in database
+
+        In write-behind mode the row is queued and committed by the
+        background writer; call flush() when it must be on disk.
+
+        Pass the ``message_id`` and ``timestamp`` of a received message to
+        have replays refused: returns False without storing when the id was
+        already seen or the message is older than the replay window (see
+        is_past_replay_window() to tell the two apart). The sender's
+        ``sequence`` number, if any, advances the sync high-water mark.
+        """
+        row = (sender, recipient, content, timestamp or time.time(), encryption_method,
+               message_id, sequence)
+        # Only messages to us can be replayed at us; our own copies are not checked
+        if message_id is None or recipient != self.username:
+            self._submit_message_row(row)
+            return True
+
+        # Check and store under one lock so concurrent copies cannot both pass
+        with self.replay_guard.lock:
+            if not self._is_new_message(message_id, row[3]):
+                return False
+            self._submit_message_row(row)
+            self.replay_guard.add(message_id)
+        return True
+
+    def _submit_message_row(self, row):
+        if self.writer:
+            self.writer.submit(row)
+        else:
+            self._write_message_rows([row])
+
+    def is_past_replay_window(self, timestamp):
+        """Whether a message sent at ``timestamp`` is too old to be checked for replays
+
+        Ids are only remembered for the replay window, so store_message
+        refuses such messages even when they are genuine (a slow sender
+        clock or late delivery).
+        """
+        return timestamp < time.time() - self.replay_guard.window
+
+    def _is_new_message(self, message_id, timestamp):
+        """Whether a message id has not been received within the replay window"""
+        if self.is_past_replay_window(timestamp):
+            return False
+        if not self.replay_guard.might_contain(message_id):
+            return True
+
+        # Possible repeat: confirm on disk, including still-queued writes
+        self.flush()
+        with self.metrics.time('db_replay_lookup'):
+            row = self.db.connection().execute(
+                "SELECT 1 FROM seen_messages WHERE owner = ? AND message_id = ?",
+                (self.username, message_id)
+            ).fetchone()
+        return row is None
+
+    def store_messages(self, messages):
+        """Store many messages in a single transaction
+
+        ``messages`` is an iterable of dicts with ``sender``, ``recipient``
+        and ``content`` keys and optional ``timestamp``,
+        ``encryption_method``, ``message_id`` and ``sequence``. No replay
+        check is made.
+        Returns the number of messages stored.
+        """
+        now = time.time()
+        rows = [(
+            msg['sender'],
+            msg['recipient'],
+            msg['content'],
+            msg.get('timestamp', now),
+            msg.get('encryption_method', 'hybrid'),
+            msg.get('message_id'),
+            msg.get('sequence')
+        ) for msg in messages]
+
+        if rows:
+            self._write_message_rows(rows)
+        return len(rows)
+
+    def _write_message_rows(self, rows, floors=None):
+        """Insert (sender, recipient, content, timestamp, method, message_id, sequence) rows in one transaction"""
+        if self.message_log:
+            # The lock keeps pending bookkeeping in log order for the checkpoint
+            with self._bookkeeping_lock:
+                with self.metrics.time('log_append'):
+                    self.message_log.append([row + (conversation_key(row[0], row[1]),) for row in rows])
+                if not self._bookkeeping and not self._bookkeeping_floors:
+                    self._bookkeeping_since = time.monotonic()
+                self._bookkeeping.extend(rows)
+                for key, floor in (floors or {}).items():
+                    self._bookkeeping_floors[key] = max(floor, self._bookkeeping_floors.get(key, 0))
+                if (len(self._bookkeeping) >= LOG_BOOKKEEPING_BATCH or
+                        time.monotonic() - self._bookkeeping_since >= LOG_BOOKKEEPING_INTERVAL):
+                    self._apply_bookkeeping()
+            return
+
+        with self.metrics.time('db_write'):
+            with self.db.transaction() as conn:
+                conn.executemany("""
+                    INSERT INTO messages (sender, recipient, content, timestamp,
+                                          encryption_method, message_id, sequence, conversation)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [row + (conversation_key(row[0], row[1]),) for row in rows])
+                self._write_bookkeeping(conn, rows, floors)
+
+    def _write_bookkeeping(self, conn, rows, floors=None):
+        """Stats, seen ids, digests and sync marks for stored rows"""
+        self._update_message_stats(conn, rows)
+        self._record_seen(conn, rows)
+        self._fold_digests(conn, ((self.username, conversation_key(row[0], row[1]), row[3], row[5])
+                                  for row in rows))
+        self._advance_sync_state(conn, rows, floors)
+
+    def _apply_bookkeeping(self):
+        """Write pending log-mode bookkeeping in one transaction"""
+        with self._bookkeeping_lock:
+            if not self._bookkeeping and not self._bookkeeping_floors:
+                return
+            with self.metrics.time('db_write'):
+                with self.db.transaction() as conn:
+                    self._write_bookkeeping(conn, self._bookkeeping, self._bookkeeping_floors)
+                    conn.execute("UPDATE log_checkpoint SET last_id = ?", (self.message_log.last_id,))
+            self._bookkeeping = []
+            self._bookkeeping_floors = {}
+
+    def _recover_bookkeeping(self):
+        """Redo bookkeeping for log messages appended after the last checkpoint
+
+        Sync floors are not in the log; a lost one is re-sent with the next
+        sync reply.
+        """
+        conn = self.db.connection()
+        row = conn.execute("SELECT last_id FROM log_checkpoint").fetchone()
+        if row is None:
+            # Logs written before checkpoints had their bookkeeping applied per batch
+            with self.db.transaction() as conn:
+                conn.execute("INSERT OR IGNORE INTO log_checkpoint (id, last_id) VALUES (0, ?)",
+                             (self.message_log.last_id,))
+            return
+
+        with self._bookkeeping_lock:
+            for _conversation, message in self.message_log.iter_after(row[0]):
+                self._bookkeeping.append((message['sender'], message['recipient'], message['content'],
+                                          message['timestamp'], message['encryption_method'],
+                                          message['message_id'], message['sequence']))
+                if len(self._bookkeeping) >= LOG_BOOKKEEPING_BATCH:
+                    self._apply_bookkeeping()
+            self._apply_bookkeeping()
+
+    def _record_seen(self, conn, rows):
+        """Remember the ids of messages received by us for replay detection"""
+        conn.executemany("""
+            INSERT OR IGNORE INTO seen_messages (owner, message_id, seen_at) VALUES (?, ?, ?)
+        """, [(self.username, row[5], row[3]) for row in rows
+              if row[5] is not None and row[1] == self.username])
+
+    def _fold_digests(self, conn, entries):
+        """Add ``(owner, conversation, timestamp, message_id)`` entries to the bucket digests"""
+        deltas = {}
+        for owner, conversation, timestamp, message_id in entries:
+            if message_id is None:
+                continue
+            key = (owner, conversation, int(timestamp // DIGEST_BUCKET))
+            count, digest = deltas.get(key, (0, 0))
+            deltas[key] = (count + 1, digest + message_digest(message_id))
+
+        for (owner, conversation, bucket), (count, digest) in deltas.items():
+            row = conn.execute("""
+                SELECT count, digest FROM conversation_digests
+                WHERE owner = ? AND conversation = ? AND bucket = ?
+            """, (owner, conversation, bucket)).fetchone()
+            if row:
+                count += row[0]
+                digest += int.from_bytes(row[1], 'big')
+            conn.execute("""
+                INSERT OR REPLACE INTO conversation_digests (owner, conversation, bucket, count, digest)
+                VALUES (?, ?, ?, ?, ?)
+            """, (owner, conversation, bucket, count, (digest % DIGEST_MODULUS).to_bytes(16, 'big')))
+
+    def _advance_sync_state(self, conn, rows, floors=None):
+        """Move sync high-water marks past the sequences stored in ``rows``
+
+        A sender's mark only covers sequences stored without gaps; ones
+        above a gap wait in sync_pending. ``floors`` maps
+        ``(conversation, sender)`` to a sequence the mark may jump to, used
+        when the sender has nothing older left to send. Our own mark is
+        simply the highest sequence used.
+        """
+        received = {}
+        for row in rows:
+            if row[6] is not None:
+                received.setdefault((conversation_key(row[0], row[1]), row[0]), set()).add(row[6])
+        for key in floors or {}:
+            received.setdefault(key, set())
+
+        for (conversation, sender), sequences in received.items():
+            row = conn.execute("""
+                SELECT high_water FROM sync_state WHERE owner = ? AND conversation = ? AND sender = ?
+            """, (self.username, conversation, sender)).fetchone()
+            high_water = row[0] if row else 0
+
+            if sender == self.username:
+                high_water = max([high_water, *sequences])
+            else:
+                pending = {seq for (seq,) in conn.execute("""
+                    SELECT sequence FROM sync_pending WHERE owner = ? AND conversation = ? AND sender = ?
+                """, (self.username, conversation, sender))}
+                pending.update(seq for seq in sequences if seq > high_water)
+                high_water = max(high_water, (floors or {}).get((conversation, sender), 0))
+                while high_water + 1 in pending:
+                    high_water += 1
+                conn.execute("""
+                    DELETE FROM sync_pending
+                    WHERE owner = ? AND conversation = ? AND sender = ? AND sequence <= ?
+                """, (self.username, conversation, sender, high_water))
+                conn.executemany("""
+                    INSERT OR IGNORE INTO sync_pending (owner, conversation, sender, sequence)
+                    VALUES (?, ?, ?, ?)
+                """, [(self.username, conversation, sender, seq) for seq in pending if seq > high_water])
+
+            conn.execute("""
+                INSERT OR REPLACE INTO sync_state (owner, conversation, sender, high_water)
+                VALUES (?, ?, ?, ?)
+            """, (self.username, conversation, sender, high_water))
+
+    def _update_message_stats(self, conn, rows):
+        """Fold a batch of stored rows into the message_stats counters"""
+        deltas = {}
+        for sender, recipient, _content, timestamp, _method, _message_id, _sequence in rows:
+            day = time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+            for owner, contact, column in ((sender, recipient, 0), (recipient, sender, 1)):
+                for key in ((owner, contact, day), (owner, contact, STATS_ALL),
+                            (owner, STATS_ALL, day), (owner, STATS_ALL, STATS_ALL)):
+                    counts = deltas.setdefault(key, [0, 0])
+                    counts[column] += 1
+
+        conn.executemany("""
+            INSERT INTO message_stats (owner, contact, day, sent, received)
             VALUES (?, ?, ?, ?, ?)
-        """, (sender, recipient, content, time.time(), encryption_method))
+            ON CONFLICT (owner, contact, day) DO UPDATE SET
+                sent = sent + excluded.sent,
+                received = received + excluded.received
+        """, [key + tuple(counts) for key, counts in deltas.items()])
 
-        conn.commit()
-        conn.close()
+    def get_stats(self, days=7, per_contact=False):
+        """Message counters for this user, read from the materialized stats table
 
-    def get_conversation(self, contact, limit=50):
-        """Get conversation history with a contact"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Totals are a single primary-key lookup; ``days`` recent per-day rows and,
+        if requested, the per-contact breakdown are short index range scans.
+        """
+        self.flush()
+        conn = self.db.connection()
+        row = conn.execute("""
+            SELECT sent, received FROM message_stats
+            WHERE owner = ? AND contact = ? AND day = ?
+        """, (self.username, STATS_ALL, STATS_ALL)).fetchone()
+        sent, received = row if row else (0, 0)
 
-        cursor.execute("""
-            SELECT sender, recipient, content, timestamp, encryption_method
-            FROM messages 
-            WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
-            ORDER BY timestamp DESC LIMIT ?
-        """, (self.username, contact, contact, self.username, limit))
+        contacts = conn.execute("""
+            SELECT contact, sent, received FROM message_stats
+            WHERE owner = ? AND day = ? AND contact != ?
+        """, (self.username, STATS_ALL, STATS_ALL)).fetchall()
+
+        recent = conn.execute("""
+            SELECT day, sent, received FROM message_stats
+            WHERE owner = ? AND contact = ? AND day != ?
+            ORDER BY day DESC LIMIT ?
+        """, (self.username, STATS_ALL, STATS_ALL, days)).fetchall()
+
+        stats = {
+            'total_messages': sent + received,
+            'sent': sent,
+            'received': received,
+            'contacts': len(contacts),
+            'per_day': {day: {'sent': s, 'received': r} for day, s, r in reversed(recent)},
+        }
+        if per_contact:
+            stats['per_contact'] = {c: {'sent': s, 'received': r} for c, s, r in contacts}
+        return stats
+
+    def digest_ranges(self, contact, ranges=None):
+        """Summarize a conversation over bucket ranges
+
+        Ranges are ``(first, end)`` pairs of DIGEST_BUCKET-sized buckets
+        counted from the epoch; the default is the whole root range. Each
+        summary is ``{'range': [first, end], 'count': n, 'digest': hex}``,
+        where the digest is the sum of message_digest() over the message
+        ids in the range, so equal histories give equal summaries.
+        """
+        self.flush()
+        conversation = conversation_key(self.username, contact)
+        conn = self.db.connection()
+
+        summaries = []
+        for first, end in ranges or [(0, DIGEST_SPAN)]:
+            count, digest = 0, 0
+            with self.metrics.time('db_digest'):
+                for bucket_count, bucket_digest in conn.execute("""
+                    SELECT count, digest FROM conversation_digests
+                    WHERE owner = ? AND conversation = ? AND bucket >= ? AND bucket < ?
+                """, (self.username, conversation, first, end)):
+                    count += bucket_count
+                    digest += int.from_bytes(bucket_digest, 'big')
+            summaries.append({
+                'range': [first, end],
+                'count': count,
+                'digest': f"{digest % DIGEST_MODULUS:032x}"
+            })
+        return summaries
+
+    def compare_digests(self, contact, remote_summaries, fanout=DIGEST_FANOUT):
+        """Compare a peer's range summaries with ours
+
+        Returns ``(descend, leaves)``. ``descend`` holds the sub-ranges of
+        differing ranges to exchange summaries for on the next round trip;
+        ``leaves`` holds differing ranges small enough to settle by
+        exchanging message ids (see range_message_ids). Each round trip
+        narrows a difference by ``fanout``, so finding one takes
+        O(log n) round trips.
+        """
+        ranges = [tuple(summary['range']) for summary in remote_summaries]
+        local = dict(zip(ranges, self.digest_ranges(contact, ranges)))
+
+        descend, leaves = [], []
+        for remote in remote_summaries:
+            first, end = remote['range']
+            mine = local[(first, end)]
+            if mine['count'] == remote['count'] and mine['digest'] == remote['digest']:
+                continue
+            if end - first <= 1 or mine['count'] + remote['count'] <= DIGEST_LEAF_SIZE:
+                leaves.append((first, end))
+            else:
+                descend.extend(split_range(first, end, fanout))
+        return descend, leaves
+
+    def range_message_ids(self, contact, ranges):
+        """Message ids of a conversation stored in the given bucket ranges"""
+        self.flush()
+        conversation = conversation_key(self.username, contact)
+        bounds = [(first * DIGEST_BUCKET, end * DIGEST_BUCKET) for first, end in ranges]
+
+        if self.message_log:
+            return [message['message_id'] for message in self.message_log.iter_conversation(conversation)
+                    if message.get('message_id') and
+                    any(start <= message['timestamp'] < stop for start, stop in bounds)]
+
+        message_ids = []
+        conn = self.db.connection()
+        partitions = self._archive_partitions(conversation)
+        for start, stop in bounds:
+            message_ids.extend(row[0] for row in conn.execute("""
+                SELECT message_id FROM messages
+                WHERE conversation = ? AND timestamp >= ? AND timestamp < ?
+                  AND message_id IS NOT NULL
+            """, (conversation, start, stop)))
+            for partition, first_timestamp, last_timestamp in partitions:
+                if first_timestamp < stop and last_timestamp >= start:
+                    message_ids.extend(self.archive.message_ids(partition, conversation, start, stop))
+        return list(dict.fromkeys(message_ids))
+
+    def sync_request(self):
+        """Build a ``sync_request`` frame advertising our high-water marks
+
+        For each contact the mark is the sequence up to which every
+        message they sent us is stored; the contact answers with
+        sync_batches() for anything above it.
+        """
+        self.flush()
+        conn = self.db.connection()
+        marks = dict(conn.execute("""
+            SELECT conversation, high_water FROM sync_state WHERE owner = ? AND sender != ?
+        """, (self.username, self.username)))
+        high_water = {
+            contact: marks.get(conversation_key(self.username, contact), 0)
+            for (contact,) in conn.execute("SELECT username FROM contacts")
+        }
+        return {'type': 'sync_request', 'sender': self.username, 'high_water': high_water}
+
+    def sync_batches(self, request, batch_size=SYNC_BATCH_SIZE):
+        """Answer a peer's ``sync_request`` with the messages it is missing
+
+        Yields ``sync_batch`` frames carrying our messages to the peer above
+        its high-water mark, oldest first, re-encrypted under their
+        original ids, timestamps and sequence numbers. Frames can be sent
+        back to back without waiting for replies. The last one is marked
+        ``final`` and names our highest sequence, so a gap we can no longer
+        fill does not hold the peer's mark back. Yields nothing when the
+        peer is up to date.
+        """
+        peer = request['sender']
+        high_water = int(request.get('high_water', {}).get(self.username, 0))
+        if not self._get_contact(peer):
+            raise ValueError(f"No public key found for {peer}")
+
+        batch, last_sequence = [], high_water
+        for message in self._messages_after(peer, high_water):
+            envelope = self.encrypt_message(peer, message['content'],
+                                            message_id=message['message_id'],
+                                            timestamp=message['timestamp'],
+                                            sequence=message['sequence'])
+            batch.append(envelope_to_transport(envelope))
+            last_sequence = message['sequence']
+            if len(batch) >= batch_size:
+                yield {'type': 'sync_batch', 'sender': self.username, 'messages': batch,
+                       'final': False}
+                batch = []
+
+        if last_sequence > high_water:
+            yield {'type': 'sync_batch', 'sender': self.username, 'messages': batch,
+                   'final': True, 'last_sequence': last_sequence}
+
+    def _messages_after(self, contact, high_water, chunk_size=256):
+        """Our messages to ``contact`` with a sequence above ``high_water``, oldest first"""
+        self.flush()
+        conversation = conversation_key(self.username, contact)
+
+        if self.message_log:
+            # Walk back from the newest message until our sequences reach the mark
+            missing, before = [], None
+            while True:
+                page = self.message_log.page(conversation, chunk_size, before)
+                for message in reversed(page):
+                    if message['sender'] != self.username or message['sequence'] is None:
+                        continue
+                    if message['sequence'] <= high_water:
+                        page = []
+                        break
+                    missing.append(message)
+                if len(page) < chunk_size:
+                    break
+                before = (page[0]['timestamp'], page[0]['id'])
+            missing.sort(key=lambda message: message['sequence'])
+            yield from missing
+            return
+
+        # A peer that was away long enough may need messages since archived
+        archived = []
+        for partition, _first, _last in self._archive_partitions(conversation):
+            archived.extend(self.archive.after_sequence(partition, conversation,
+                                                        self.username, high_water))
+        archived.sort(key=lambda message: message['sequence'])
+
+        yield from heapq.merge(archived, self._hot_messages_after(conversation, high_water, chunk_size),
+                               key=lambda message: message['sequence'])
+
+    def _hot_messages_after(self, conversation, high_water, chunk_size):
+        conn = self.db.connection()
+        last_sequence = high_water
+        while True:
+            rows = conn.execute("""
+                SELECT content, timestamp, message_id, sequence FROM messages
+                WHERE conversation = ? AND sender = ? AND sequence > ?
+                ORDER BY sequence LIMIT ?
+            """, (conversation, self.username, last_sequence, chunk_size)).fetchall()
+
+            for content, timestamp, message_id, sequence in rows:
+                yield {'content': content, 'timestamp': timestamp,
+                       'message_id': message_id, 'sequence': sequence}
+
+            if len(rows) < chunk_size:
+                return
+            last_sequence = rows[-1][3]
+
+    def ingest_sync_batch(self, batch, workers=None):
+        """Store the messages of a peer's ``sync_batch`` frame
+
+        Envelopes are decrypted in parallel and the new messages written in
+        one transaction. Messages we already hold (by sequence number) or
+        that were not sent by the batch's sender are skipped, so batches
+        may overlap live delivery or arrive twice. Returns a dict with the
+        newly stored ``messages`` (decrypt_message results, oldest first)
+        and the number of ``duplicates`` and ``errors``.
+        """
+        peer = batch['sender']
+        envelopes = [envelope_from_transport(item) for item in batch.get('messages', [])]
+        results = self.decrypt_many(envelopes, workers)
+        conversation = conversation_key(self.username, peer)
 
-        messages = cursor.fetchall()
-        conn.close()
+        fresh, duplicates, errors = {}, 0, 0
+        # Same lock as store_message, so a live copy cannot slip in between
+        with self.replay_guard.lock:
+            self.flush()
+            conn = self.db.connection()
+            row = conn.execute("""
+                SELECT high_water FROM sync_state WHERE owner = ? AND conversation = ? AND sender = ?
+            """, (self.username, conversation, peer)).fetchone()
+            high_water = row[0] if row else 0
+            held = {seq for (seq,) in conn.execute("""
+                SELECT sequence FROM sync_pending WHERE owner = ? AND conversation = ? AND sender = ?
+            """, (self.username, conversation, peer))}
+
+            for result in results:
+                sequence = result.get('sequence')
+                if 'error' in result or result['sender'] != peer or not isinstance(sequence, int):
+                    errors += 1
+                elif sequence <= high_water or sequence in held or sequence in fresh:
+                    duplicates += 1
+                else:
+                    fresh[sequence] = result
+
+            messages = [fresh[sequence] for sequence in sorted(fresh)]
+            rows = [(peer, self.username, message['message'], message['timestamp'],
+                     message['encryption_method'], message['message_id'], message['sequence'])
+                    for message in messages]
+            floors = None
+            if batch.get('final') and isinstance(batch.get('last_sequence'), int):
+                floors = {(conversation, peer): batch['last_sequence']}
+
+            if rows or floors:
+                self._write_message_rows(rows, floors)
+            for message in messages:
+                self.replay_guard.add(message['message_id'])
+
+        return {'messages': messages, 'duplicates': duplicates, 'errors': errors}
+
+    def flush(self, timeout=None):
+        """Wait until all queued messages are durably stored"""
+        if self.writer:
+            self.writer.flush(timeout)
+        if self.message_log:
+            self._apply_bookkeeping()
+
+    def get_conversation(self, contact, limit=50, before=None):
+        """Get conversation history with a contact, oldest first
+
+        Pages backwards with a keyset cursor: pass
+        ``before=(oldest['timestamp'], oldest['id'])`` from the previous page
+        to fetch the messages that precede it.
+        """
+        # Read our own queued writes
+        self.flush()
+
+        conversation = conversation_key(self.username, contact)
+        if self.message_log:
+            with self.metrics.time('log_get_conversation'):
+                return self.message_log.page(conversation, limit, before)
+
+        conn = self.db.connection()
+
+        with self.metrics.time('db_get_conversation'):
+            if before is None:
+                messages = conn.execute("""
+                    SELECT id, sender, recipient, content, timestamp, encryption_method, message_id,
+                           sequence
+                    FROM messages
+                    WHERE conversation = ?
+                    ORDER BY timestamp DESC, id DESC LIMIT ?
+                """, (conversation, limit)).fetchall()
+            else:
+                before_timestamp, before_id = before
+                messages = conn.execute("""
+                    SELECT id, sender, recipient, content, timestamp, encryption_method, message_id,
+                           sequence
+                    FROM messages
+                    WHERE conversation = ? AND timestamp <= ?
+                      AND (timestamp < ? OR id < ?)
+                    ORDER BY timestamp DESC, id DESC LIMIT ?
+                """, (conversation, before_timestamp, before_timestamp, before_id,
+                      limit)).fetchall()
+
+        messages = [{
+            'id': msg[0],
+            'sender': msg[1],
+            'recipient': msg[2],
+            'content': msg[3],
+            'timestamp': msg[4],
+            'encryption_method': msg[5],
+            'message_id': msg[6],
+            'sequence': msg[7]
+        } for msg in messages]
+
+        partitions = self._archive_partitions(conversation)
+        if partitions:
+            messages = self._merge_archived_page(conversation, partitions, messages, limit, before)
+        messages.reverse()
+        return messages
+
+    def _archive_partitions(self, conversation):
+        """``(partition, first_timestamp, last_timestamp)`` archived for a conversation, oldest first"""
+        partitions = self.archive_catalog.get(conversation)
+        if partitions is None:
+            partitions = self.db.connection().execute("""
+                SELECT partition, first_timestamp, last_timestamp FROM archive_partitions
+                WHERE conversation = ? ORDER BY partition
+            """, (conversation,)).fetchall()
+            self.archive_catalog[conversation] = partitions
+        return partitions
+
+    def _merge_archived_page(self, conversation, partitions, hot, limit, before):
+        """Combine a newest-first page of hot messages with archived ones"""
+        # A full hot page only competes with archived messages newer than its oldest
+        floor = hot[-1]['timestamp'] if len(hot) >= limit else float('-inf')
+
+        archived = []
+        with self.metrics.time('archive_read'):
+            for partition, first_timestamp, last_timestamp in reversed(partitions):
+                if last_timestamp < floor:
+                    break
+                if before is not None and first_timestamp > before[0]:
+                    continue
+                # Partitions cover disjoint months, so newer ones are exhausted first
+                archived.extend(self.archive.page(partition, conversation,
+                                                  limit - len(archived), before))
+                if len(archived) >= limit:
+                    break
+
+        if not archived:
+            return hot
+        # An interrupted move can leave a row in both tiers for a moment
+        merged = {message['id']: message for message in archived + hot}
+        return sorted(merged.values(), key=lambda message: (message['timestamp'], message['id']),
+                      reverse=True)[:limit]
+
+    def iter_conversation(self, contact, chunk_size=1000):
+        """Yield every message with a contact, oldest first, in bounded chunks
+
+        Each chunk is a separate keyset query, so no read transaction is
+        held open between chunks and memory stays flat however long the
+        history is.
+        """
+        self.flush()
+
+        conversation = conversation_key(self.username, contact)
+        if self.message_log:
+            yield from self.message_log.iter_conversation(conversation)
+            return
+
+        hot = self._iter_hot_conversation(conversation, chunk_size)
+        partitions = self._archive_partitions(conversation)
+        if not partitions:
+            yield from hot
+            return
+
+        # Archive partitions are disjoint months, so chained they are already in order
+        archived = (message for partition, _first, _last in partitions
+                    for message in self.archive.iter_conversation(partition, conversation, chunk_size))
+        last_id = None
+        for message in heapq.merge(archived, hot, key=lambda message: (message['timestamp'], message['id'])):
+            if message['id'] != last_id:
+                yield message
+            last_id = message['id']
+
+    def _iter_hot_conversation(self, conversation, chunk_size):
+        """Keyset-chunked, oldest-first scan of a conversation in enclave.db"""
+        conn = self.db.connection()
+        last_timestamp, last_id = float('-inf'), -1
+
+        while True:
+            messages = conn.execute("""
+                SELECT id, sender, recipient, content, timestamp, encryption_method, message_id,
+                       sequence
+                FROM messages
+                WHERE conversation = ? AND timestamp >= ?
+                  AND (timestamp > ? OR id > ?)
+                ORDER BY timestamp, id LIMIT ?
+            """, (conversation, last_timestamp, last_timestamp, last_id,
+                  chunk_size)).fetchall()
+
+            for msg in messages:
+                yield {
+                    'id': msg[0],
+                    'sender': msg[1],
+                    'recipient': msg[2],
+                    'content': msg[3],
+                    'timestamp': msg[4],
+                    'encryption_method': msg[5],
+                    'message_id': msg[6],
+                    'sequence': msg[7]
+                }
+
+            if len(messages) < chunk_size:
+                return
+            last_id, last_timestamp = messages[-1][0], messages[-1][4]
+
+    def export_conversation(self, contact, path, fmt=None, compress=None,
+                            progress=None, chunk_size=1000):
+        """Stream a whole conversation to ``path`` as text or JSON Lines
+
+        ``fmt`` is ``'text'`` or ``'jsonl'`` and ``compress`` enables gzip;
+        both default from the file name (``.jsonl``/``.json``, ``.gz``).
+        ``progress(done, total)`` is called after every chunk. The file is
+        written next to ``path`` and moved into place when complete.
+        Returns the number of messages exported.
+        """
+        if compress is None:
+            compress = path.endswith('.gz')
+        if fmt is None:
+            base = path[:-3] if path.endswith('.gz') else path
+            fmt = 'jsonl' if base.endswith(('.jsonl', '.json')) else 'text'
+        if fmt not in ('text', 'jsonl'):
+            raise ValueError(f"Unsupported export format: {fmt}")
+
+        # Materialized counters give the total without scanning messages
+        row = self.db.connection().execute("""
+            SELECT sent + received FROM message_stats
+            WHERE owner = ? AND contact = ? AND day = ?
+        """, (self.username, contact, STATS_ALL)).fetchone()
+        total = row[0] if row else 0
+
+        temp_path = f"{path}.part-{secrets.token_hex(4)}"
+        opener = gzip.open if compress else open
+        exported = 0
+        try:
+            with opener(temp_path, 'wt', encoding='utf-8') as f:
+                if fmt == 'text':
+                    f.write(f"Enclave Messenger Chat Export\n")
+                    f.write(f"Participants: {self.username} <-> {contact}\n")
+                    f.write(f"Exported: {datetime.now()}\n")
+                    f.write("=" * 60 + "\n\n")
+
+                for msg in self.iter_conversation(contact, chunk_size):
+                    if fmt == 'text':
+                        timestamp = datetime.fromtimestamp(msg['timestamp'])
+                        f.write(f"[{timestamp}] {msg['sender']}: {msg['content']}\n")
+                    else:
+                        f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+
+                    exported += 1
+                    if progress and exported % chunk_size == 0:
+                        progress(exported, max(total, exported))
+
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if progress:
+            progress(exported, exported)
+        return exported
+
+    @staticmethod
+    def _fts_query(query):
+        """Turn user input into an FTS5 query matching all words
+
+        Each word is quoted so punctuation is never parsed as FTS syntax;
+        a trailing ``*`` still requests a prefix match.
+        """
+        terms = []
+        for word in query.split():
+            prefix = word.endswith('*') and len(word) > 1
+            word = word.rstrip('*') if prefix else word
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+        return ' '.join(terms)
+
+    def search_messages(self, query, contact=None, limit=20, cursor=None):
+        """Full-text search over stored messages, newest first
+
+        Restricted to conversations with ``contact`` when given. Pass
+        ``cursor=results[-1]['id']`` to fetch the next page.
+        """
+        if not self.search_enabled:
+            if self.message_log:
+                raise ValueError("Full-text search is not supported with storage='log'")
+            raise ValueError("Full-text search is not available in this SQLite build")
+
+        fts_query = self._fts_query(query)
+        if not fts_query:
+            return []
+
+        # Include our own queued writes
+        self.flush()
+
+        conditions = ["messages_fts MATCH ?"]
+        params = [fts_query]
+        if cursor is not None:
+            conditions.append("messages_fts.rowid < ?")
+            params.append(cursor)
+        if contact is not None:
+            conditions.append("m.conversation = ?")
+            params.append(conversation_key(self.username, contact))
+        else:
+            conditions.append("(m.sender = ? OR m.recipient = ?)")
+            params.extend([self.username, self.username])
+
+        with self.metrics.time('db_search'):
+            rows = self.db.connection().execute(f"""
+                SELECT m.id, m.sender, m.recipient, m.content, m.timestamp, m.encryption_method,
+                       m.message_id
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE {' AND '.join(conditions)}
+                ORDER BY messages_fts.rowid DESC LIMIT ?
+            """, params + [limit]).fetchall()
 
         return [{
-            'sender': msg[0],
-            'recipient': msg[1],
-            'content': msg[2],
-            'timestamp': msg[3],
-            'encryption_method': msg[4]
-        } for msg in reversed(messages)]
+            'id': row[0],
+            'sender': row[1],
+            'recipient': row[2],
+            'content': row[3],
+            'timestamp': row[4],
+            'encryption_method': row[5],
+            'message_id': row[6]
+        } for row in rows]
 
     def get_message_hash(self, message):
         """Generate hash for message integrity verification"""
@@ -325,3 +3002,180 @@ class SecureMessenger:
     def verify_message_integrity(self, message, expected_hash):
         """Verify message integrity using hash"""
         return self.get_message_hash(message) == expected_hash
+
+    def purge_session_keys(self, max_age=None, batch_size=1000):
+        """Delete used and expired session keys in small transactions
+
+        Rows older than ``max_age`` seconds (default: the session key TTL)
+        are removed along with every used key. Each batch commits on its
+        own so writers are never blocked for long. Returns the number of
+        rows deleted.
+        """
+        max_age = self.session_key_ttl if max_age is None else max_age
+        cutoff = time.time() - max_age
+        deleted = 0
+
+        for condition, params in (("used", ()), ("created_at < ?", (cutoff,))):
+            while True:
+                with self.db.transaction() as conn:
+                    count = conn.execute(f"""
+                        DELETE FROM session_keys WHERE rowid IN (
+                            SELECT rowid FROM session_keys WHERE {condition} LIMIT ?
+                        )
+                    """, params + (batch_size,)).rowcount
+                deleted += count
+                if count < batch_size:
+                    break
+
+        return deleted
+
+    def archive_messages(self, max_age=None, batch_size=1000):
+        """Move messages older than ``max_age`` seconds to the monthly archive
+
+        Defaults to the ``archive_after`` age given at construction. Each
+        batch is first written to its month's archive file, then deleted
+        from enclave.db, so an interruption at worst repeats a batch.
+        History, export and reconciliation keep reading both tiers; stats,
+        digests and sync state are unaffected, but archived messages drop
+        out of full-text search. Returns the number of messages moved.
+        """
+        max_age = max_age or self.archive_after
+        if not max_age or self.message_log:
+            return 0
+
+        self.flush()
+        cutoff = time.time() - max_age
+        moved = 0
+
+        while True:
+            rows = self.db.connection().execute("""
+                SELECT id, conversation, sender, recipient, content, timestamp, message_type,
+                       encryption_method, message_id, sequence
+                FROM messages WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+            """, (cutoff, batch_size)).fetchall()
+            if not rows:
+                return moved
+
+            partitions, catalog = {}, {}
+            for row in rows:
+                partition = partition_for(row[5])
+                partitions.setdefault(partition, []).append(row)
+                count, first, last = catalog.get((row[1], partition), (0, row[5], row[5]))
+                catalog[(row[1], partition)] = (count + 1, min(first, row[5]), max(last, row[5]))
+
+            with self.metrics.time('archive_write'):
+                for partition, batch in partitions.items():
+                    self.archive.write(partition, batch)
+
+            with self.db.transaction() as conn:
+                conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+                conn.executemany("""
+                    INSERT INTO archive_partitions
+                        (conversation, partition, count, first_timestamp, last_timestamp)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (conversation, partition) DO UPDATE SET
+                        count = count + excluded.count,
+                        first_timestamp = min(first_timestamp, excluded.first_timestamp),
+                        last_timestamp = max(last_timestamp, excluded.last_timestamp)
+                """, [key + value for key, value in catalog.items()])
+            self.archive_catalog.clear()
+            moved += len(rows)
+
+    def purge_seen_messages(self, batch_size=1000):
+        """Forget received message ids older than the replay window
+
+        Messages that old are refused by store_message anyway. Returns the
+        number of ids removed.
+        """
+        cutoff = time.time() - self.replay_guard.window
+        deleted = 0
+        while True:
+            with self.db.transaction() as conn:
+                count = conn.execute("""
+                    DELETE FROM seen_messages WHERE (owner, message_id) IN (
+                        SELECT owner, message_id FROM seen_messages WHERE seen_at < ? LIMIT ?
+                    )
+                """, (cutoff, batch_size)).rowcount
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    def compact_database(self, pages=None, full=False):
+        """Return free pages to the filesystem
+
+        With incremental auto-vacuum, releases up to ``pages`` free pages
+        (all if None). ``full=True`` runs VACUUM, which also converts
+        databases created before auto-vacuum was enabled. Returns False if
+        nothing could be done without a full VACUUM.
+        """
+        conn = self.db.connection()
+        self.flush()
+
+        if full:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            return True
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return False
+
+        # execute() steps the pragma once, freeing a single page; a script
+        # runs it to completion
+        limit = "" if pages is None else f"({int(pages)})"
+        conn.executescript(f"PRAGMA incremental_vacuum{limit};")
+        return True
+
+    def run_maintenance(self):
+        """One retention pass: purge spent keys and old message ids, archive old
+        messages, release freed pages and compact the log"""
+        self.flush()
+        self.purge_session_keys()
+        self.purge_seen_messages()
+        self.archive_messages()
+        self.compact_database(pages=1000)
+        if self.message_log:
+            self.message_log.compact(self.log_retention)
+
+    def _maintenance_loop(self, interval):
+        while not self._maintenance_stop.wait(interval):
+            try:
+                self.run_maintenance()
+            except (sqlite3.Error, OSError):
+                # Retry on the next pass, e.g. after a busy timeout
+                pass
+
+    def get_cache_stats(self):
+        """Sizes and hit rates of the in-memory caches"""
+        return {
+            'contacts': self.contact_cache.stats(),
+            'aead': self.aead_cache.stats(),
+            'archive_catalog': self.archive_catalog.stats(),
+            'replay': self.replay_guard.stats()
+        }
+
+    def get_metrics(self):
+        """Per-stage timing snapshot; empty unless metrics are enabled"""
+        return self.metrics.snapshot()
+
+    def close(self):
+        """Write any queued messages and release database connections"""
+        self._maintenance_stop.set()
+        if self._maintenance_thread:
+            self._maintenance_thread.join()
+
+        try:
+            if self.writer:
+                self.writer.close()
+            if self.message_log:
+                self._apply_bookkeeping()
+        finally:
+            if self.message_log:
+                self.message_log.close()
+            self.archive.close()
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()